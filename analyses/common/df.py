@@ -1,45 +1,203 @@
 # coding: utf-8
 
+import collections
+import functools
+import glob
+import hashlib
+import json
 import os
+import shutil
+import numpy as np
 import pandas as pd
-from typing import Optional, List, Callable
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pcsv
+import pyarrow.dataset as pds
+import pyarrow.parquet as pq
+import time
+import types
+from typing import Any, Callable, Dict, Iterator, List, Optional, Set, Tuple, Union
 
-from .utils import _resolve_dir, _get_dir
+from .utils import _resolve_dir, _get_dir, _record_metric, _get_cache_compression
 
 __all__ = [
     "get_df",
     "get_deduped_df",
+    "get_table",
+    "get_deduped_table",
+    "get_df_iter",
+    "get_deduped_df_iter",
     ]
 
-def get_df(filename: str, subdir: Optional[str]=None, drop: Optional[List[str]]=None, precache_function: Optional[Callable[[pd.DataFrame], pd.DataFrame]]=None, **kwargs) -> pd.DataFrame:
+# the Parquet metadata key that cached tables keep their fingerprint in
+FINGERPRINT_KEY = b'boa.fingerprint'
+FINGERPRINT_VERSION = 4
+
+# where the hashes of inputs are kept, see _stat_input()
+DIGESTS = 'data/parquet/.digests.json'
+
+# cached tables keep the rows in the order they were read, which decides the
+# copy of a duplicate that is kept, and are written in row groups small enough
+# that filters can skip most of a table using the row groups' statistics (Boa
+# outputs are grouped by their keys, e.g. by project)
+CACHE_ROW_GROUP_SIZE = 128 * 1024
+
+# how many MB of loaded tables to keep in memory, so analyses run in one
+# process only load each table once (bin/run-analyses.py turns this on)
+MEMO_BYTES = int(os.environ.get('BOA_DF_MEMO_MB', 0)) * 1024 * 1024
+
+# partitioned caches (see get_df_iter()) split tables into this many files by
+# project, and are read in batches of at most this many rows, a few partitions
+# and batches ahead at a time
+PARTITIONS = 16
+BATCH_SIZE = 64 * 1024
+READAHEAD = 2
+
+Filters = Union[List[Tuple[str, str, Any]], List[List[Tuple[str, str, Any]]]]
+
+def get_df(filename: str, subdir: Optional[str]=None, drop: Optional[List[str]]=None, precache_function: Optional[Callable[[pd.DataFrame], pd.DataFrame]]=None, columns: Optional[List[str]]=None, filters: Optional[Filters]=None, dtype_backend: Optional[str]=None, **kwargs) -> pd.DataFrame:
     '''Loads a CSV file into a DataFrame. Extra keyword arguments are passed directly to read_csv.
 
+    If the output was converted straight to Parquet ('"format": "parquet"' in
+    the study config), that typed file is loaded instead of the CSV, as long
+    as 'names' is the only extra keyword argument.  'names' then renames the
+    columns.  Likewise, a CSV with an up to date schema sidecar is read by
+    Arrow's multi-threaded CSV reader, with the column types it lists.
+
+    The table is cached in 'data/parquet/', along with a fingerprint of the
+    file it was read from, the keyword arguments, 'drop' and the code of
+    'precache_function'.  The cache is only rebuilt if any of them changed.
+
+    The cache always holds the whole table, in the order it was read.
+    'columns' and 'filters' are handed to the Parquet reader, so only those
+    columns are decoded, and row groups that cannot match the filters (e.g.,
+    other projects) are skipped.
+
     Args:
         filename (str): the CSV file to load, without the '.csv' extension
         subdir (Optional[str], optional): the sub-directory, underneath 'data/csv/', that it lives in. Defaults to None.
         drop (Optional[List[str]], optional): Any columns to drop from the table after loading. Defaults to None.
         precache_function (Callable[DataFrame] -> DataFrame, optional): a function to modify the the data frame before caching. Defaults to None.
+        columns (Optional[List[str]], optional): the only columns to load. Defaults to None, for all of them.
+        filters (Optional[Filters], optional): only loads rows matching these filters, in pyarrow.parquet.read_table()'s format, e.g. [('project', 'in', projects)]. Defaults to None.
+        dtype_backend (Optional[str], optional): 'pyarrow' to get columns with ArrowDtype types, which share the Arrow data instead of copying it into NumPy arrays. Defaults to None, for NumPy types.
 
     Returns:
         pd.DataFrame: the CSV file as a Pandas DataFrame
     '''
-    try:
-        df = pd.read_parquet(_resolve_dir(f'data/parquet/{_get_dir(subdir)}{filename}.parquet'))
-    except:
-        df = pd.read_csv(_resolve_dir(f'data/csv/{_get_dir(subdir)}{filename}.csv'), index_col=False, **kwargs)
+    return _to_pandas(_get_table(filename, subdir, drop, precache_function, columns, filters, kwargs), dtype_backend)
+
+def get_table(filename: str, subdir: Optional[str]=None, drop: Optional[List[str]]=None, precache_function: Optional[Callable[[pd.DataFrame], pd.DataFrame]]=None, columns: Optional[List[str]]=None, filters: Optional[Filters]=None, **kwargs) -> pa.Table:
+    '''Loads a CSV file like get_df(), but as an Arrow Table read straight
+    from the Parquet cache.  Any index that 'precache_function' set is not
+    included.
+
+    Returns:
+        pa.Table: the CSV file as an Arrow Table
+    '''
+    return _drop_index(_get_table(filename, subdir, drop, precache_function, columns, filters, kwargs))
+
+def _get_table(filename: str, subdir: Optional[str], drop: Optional[List[str]], precache_function: Optional[Callable[[pd.DataFrame], pd.DataFrame]], columns: Optional[List[str]], filters: Optional[Filters], kwargs: Dict[str, Any], memo: bool=True) -> pa.Table:
+    start = time.perf_counter()
+    cache = _resolve_dir(f'data/parquet/{_get_dir(subdir)}{filename}.parquet')
+    inputs, fingerprint = _get_df_fingerprint(filename, subdir, drop, precache_function, kwargs)
+    key = _memo_key(cache, fingerprint, columns, filters)
+    table = _memo_get(key, fingerprint) if memo else None
+    if table is not None:
+        _record_metric('memo-load', f'{_get_dir(subdir)}{filename}', time.perf_counter() - start, rows=table.num_rows)
+        return table
+
+    table, recorded = _read_cache(cache, fingerprint, columns, filters)
+    if table is not None:
+        _record_metric('parquet-load', f'{_get_dir(subdir)}{filename}', time.perf_counter() - start, rows=table.num_rows)
+    else:
+        fingerprint = recorded = _record_inputs(fingerprint)
+        df = None
+        if inputs['source'] is not None:
+            df = pd.read_parquet(inputs['source'])
+            if 'names' in kwargs:
+                df.columns = kwargs['names']
+        elif inputs['sidecar'] is not None:
+            df = _read_typed_csv(inputs['csv'], inputs['sidecar'], kwargs.get('names'))
+        if df is None:
+            df = pd.read_csv(inputs['csv'], index_col=False, **kwargs)
         if drop:
             df = df.drop(drop, axis=1)
         if precache_function:
             df = precache_function(df)
-        os.makedirs(_resolve_dir(f'data/parquet/{_get_dir(subdir)}'), 0o755, True)
-        df.to_parquet(_resolve_dir(f'data/parquet/{_get_dir(subdir)}{filename}.parquet'), compression='gzip')
-    return df
+        table = _select(_write_cache(df, cache, fingerprint), columns, filters)
+        _record_metric('parquet-build', f'{_get_dir(subdir)}{filename}', time.perf_counter() - start, rows=table.num_rows)
+    if memo:
+        _memo_put(key, recorded, table)
+    return table
 
-def get_deduped_df(filename: str, subdir: Optional[str]=None, dupesdir: Optional[str]=None, drop: Optional[List[str]]=None, precache_function: Optional[Callable[[pd.DataFrame], pd.DataFrame]]=None, ts: bool=False, **kwargs) -> pd.DataFrame:
+def _get_df_fingerprint(filename: str, subdir: Optional[str], drop: Optional[List[str]], precache_function: Optional[Callable], kwargs: Dict[str, Any]) -> Tuple[Dict[str, Optional[str]], Dict[str, Any]]:
+    '''Finds which files get_df() reads a table from, and fingerprints them
+    along with everything else the cached table depends on.
+
+    Returns:
+        Tuple[Dict[str, Optional[str]], Dict[str, Any]]: the Parquet 'source', 'csv' and schema 'sidecar' to read (each None if not used), and the fingerprint
+    '''
+    source = _resolve_dir(f'data/csv/{_get_dir(subdir)}{filename}.parquet')
+    sidecar = _resolve_dir(f'data/csv/{_get_dir(subdir)}{filename}.schema.json')
+    inputs = {
+        'source': source if os.path.exists(source) and set(kwargs) <= {'names'} else None,
+        'csv': _resolve_dir(f'data/csv/{_get_dir(subdir)}{filename}.csv'),
+        'sidecar': sidecar if os.path.exists(sidecar) and set(kwargs) <= {'names'} else None,
+    }
+    if inputs['source'] is not None:
+        inputs['csv'] = inputs['sidecar'] = None
+    return inputs, _fingerprint([x for x in inputs.values() if x is not None], kwargs=kwargs, drop=drop, precache_function=precache_function)
+
+def _read_typed_csv(csv: str, sidecar: str, names: Optional[List[str]]=None) -> Optional[pd.DataFrame]:
+    '''Reads a CSV file using the column types in its schema sidecar.
+
+    Returns:
+        Optional[pd.DataFrame]: the CSV file, or None if there is no sidecar, it is out of date, or the CSV does not match it
+    '''
+    options = _typed_csv_options(csv, sidecar, names)
+    if options is None:
+        return None
+    try:
+        table = pcsv.read_csv(csv, read_options=options[0], convert_options=options[1])
+    except (pa.ArrowInvalid, ValueError):
+        return None
+    return table.to_pandas()
+
+def _typed_csv_options(csv: str, sidecar: str, names: Optional[List[str]]=None) -> Optional[Tuple[pcsv.ReadOptions, pcsv.ConvertOptions]]:
+    '''Gets the Arrow CSV reader options for the column types in a CSV file's
+    schema sidecar, or None if the sidecar is missing or out of date.'''
+    try:
+        with open(sidecar) as f:
+            schema = json.load(f)
+        if os.path.getsize(csv) != schema['bytes']:
+            return None
+    except (OSError, ValueError, KeyError):
+        return None
+
+    columns = schema['columns']
+    if names is None:
+        names = [c['name'] for c in columns]
+    if len(names) != len(columns):
+        return None
+
+    try:
+        return (pcsv.ReadOptions(column_names=names, skip_rows=1 if schema['header'] else 0),
+                # strings can be missing values too, like with read_csv()
+                pcsv.ConvertOptions(column_types={name: pa.type_for_alias(c['type']) for name, c in zip(names, columns)},
+                                    strings_can_be_null=True))
+    except (KeyError, ValueError):
+        return None
+
+def get_deduped_df(filename: str, subdir: Optional[str]=None, dupesdir: Optional[str]=None, drop: Optional[List[str]]=None, precache_function: Optional[Callable[[pd.DataFrame], pd.DataFrame]]=None, ts: bool=False, columns: Optional[List[str]]=None, filters: Optional[Filters]=None, dtype_backend: Optional[str]=None, **kwargs) -> pd.DataFrame:
     '''Loads a CSV file into a DataFrame and de-duplicates the data.
 
     This function assumes your table has columns named 'project' and 'file', and no column named 'hash'.
 
+    Duplicates come from the dupes index ('dupes-index.parquet', made by
+    bin/build-dupes-index.py) in 'dupesdir' if there is one, or else from the
+    'dupes' CSV made by bin/gendupes.py.
+
     Args:
         filename (str): the CSV file to load, without the '.csv' extension
         subdir (Optional[str], optional): the sub-directory, underneath 'data/csv/', that it lives in. Defaults to None.
@@ -47,26 +205,593 @@ def get_deduped_df(filename: str, subdir: Optional[str]=None, dupesdir: Optional
         drop (Optional[List[str]], optional): Any columns to drop from the table after loading. Defaults to None.
         precache_function (Callable[DataFrame] -> DataFrame, optional): a function to modify the the data frame before caching. Defaults to None.
         ts (bool): if the hash file also has the file timestamps or not
+        columns (Optional[List[str]], optional): the only columns to load. Defaults to None, for all of them.
+        filters (Optional[Filters], optional): only loads rows matching these filters, see get_df(). Defaults to None.
+        dtype_backend (Optional[str], optional): 'pyarrow' to get columns with ArrowDtype types, see get_df(). Defaults to None.
 
     Returns:
         pd.DataFrame: the CSV file as a Pandas DataFrame
     '''
+    return _to_pandas(_get_deduped_table(filename, subdir, dupesdir, drop, precache_function, ts, columns, filters, kwargs), dtype_backend)
+
+def get_deduped_table(filename: str, subdir: Optional[str]=None, dupesdir: Optional[str]=None, drop: Optional[List[str]]=None, precache_function: Optional[Callable[[pd.DataFrame], pd.DataFrame]]=None, ts: bool=False, columns: Optional[List[str]]=None, filters: Optional[Filters]=None, **kwargs) -> pa.Table:
+    '''Loads a CSV file and de-duplicates the data like get_deduped_df(), but
+    as an Arrow Table read straight from the Parquet cache.
+
+    Returns:
+        pa.Table: the CSV file as an Arrow Table
+    '''
+    return _drop_index(_get_deduped_table(filename, subdir, dupesdir, drop, precache_function, ts, columns, filters, kwargs))
+
+def _get_deduped_table(filename: str, subdir: Optional[str], dupesdir: Optional[str], drop: Optional[List[str]], precache_function: Optional[Callable[[pd.DataFrame], pd.DataFrame]], ts: bool, columns: Optional[List[str]], filters: Optional[Filters], kwargs: Dict[str, Any]) -> pa.Table:
+    start = time.perf_counter()
+    names = ['var', 'hash', 'project', 'ts', 'file'] if ts else ['var', 'hash', 'project', 'file']
+    cache = _resolve_dir(f'data/parquet/{_get_dir(subdir)}{filename}-deduped.parquet')
+    _, fingerprint = _get_df_fingerprint(filename, subdir, drop, precache_function, kwargs)
+    fingerprint = _fingerprint(list(fingerprint['inputs']) + [_get_dupes_source(dupesdir)], df=fingerprint['options'], names=names)
+    key = _memo_key(cache, fingerprint, columns, filters)
+    table = _memo_get(key, fingerprint)
+    if table is not None:
+        _record_metric('memo-load', f'{_get_dir(subdir)}{filename}-deduped', time.perf_counter() - start, rows=table.num_rows)
+        return table
+
+    table, recorded = _read_cache(cache, fingerprint, columns, filters)
+    if table is not None:
+        _record_metric('parquet-load', f'{_get_dir(subdir)}{filename}-deduped', time.perf_counter() - start, rows=table.num_rows)
+    else:
+        fingerprint = recorded = _record_inputs(fingerprint)
+        # only the de-duplicated table is kept in memory, not the one it is made from
+        df = _remove_dupes(_to_pandas(_get_table(filename, subdir, drop, precache_function, None, None, kwargs, memo=False)), dupesdir, names=names)
+        table = _select(_write_cache(df, cache, fingerprint), columns, filters)
+        _record_metric('parquet-build', f'{_get_dir(subdir)}{filename}-deduped', time.perf_counter() - start, rows=table.num_rows)
+    _memo_put(key, recorded, table)
+    return table
+
+def get_df_iter(filename: str, subdir: Optional[str]=None, drop: Optional[List[str]]=None, columns: Optional[List[str]]=None, filters: Optional[Filters]=None, batch_size: int=BATCH_SIZE, partitions: int=PARTITIONS, dtype_backend: Optional[str]=None, **kwargs) -> Iterator[pd.DataFrame]:
+    '''Loads a CSV file like get_df(), but as DataFrames of at most
+    'batch_size' rows, so tables larger than memory can be processed.
+
+    The table is streamed into a partitioned cache in 'data/parquet/'
+    (e.g., 'data/parquet/kotlin/rq1.parts/'), which holds 'partitions'
+    Parquet files.  Rows are put in a file by a hash of their 'project', so
+    all rows of a project are in the same file, and a filter on 'project'
+    only reads the files that can have it.  Files are read in parallel, a
+    few batches ahead.
+
+    Unlike get_df(), there is no 'precache_function', as it would only see
+    one batch at a time.  Batches come in no particular order.
+
+    Args:
+        filename (str): the CSV file to load, without the '.csv' extension
+        subdir (Optional[str], optional): the sub-directory, underneath 'data/csv/', that it lives in. Defaults to None.
+        drop (Optional[List[str]], optional): Any columns to drop from the table after loading. Defaults to None.
+        columns (Optional[List[str]], optional): the only columns to load. Defaults to None, for all of them.
+        filters (Optional[Filters], optional): only loads rows matching these filters, see get_df(). Defaults to None.
+        batch_size (int, optional): the most rows in each DataFrame. Defaults to BATCH_SIZE.
+        partitions (int, optional): how many files to partition the cache into. Defaults to PARTITIONS.
+        dtype_backend (Optional[str], optional): 'pyarrow' to get columns with ArrowDtype types, see get_df(). Defaults to None.
+
+    Returns:
+        Iterator[pd.DataFrame]: the CSV file, in batches
+    '''
+    start = time.perf_counter()
+    cache = _resolve_dir(f'data/parquet/{_get_dir(subdir)}{filename}.parts')
+    inputs, fingerprint = _get_df_fingerprint(filename, subdir, drop, None, kwargs)
+    fingerprint = _fingerprint(list(fingerprint['inputs']), df=fingerprint['options'], partitions=partitions)
+    # later builds switch the cache to another version, which this one does not see
+    version = os.path.realpath(cache)
+    if _read_fingerprint(_get_partition(version, 0), fingerprint) is None or not all(os.path.exists(_get_partition(version, i)) for i in range(partitions)):
+        rows, version = _write_dataset(_iter_source(inputs, drop, kwargs, batch_size), cache, _record_inputs(fingerprint), partitions)
+        _record_metric('parquet-build', f'{_get_dir(subdir)}{filename}.parts', time.perf_counter() - start, rows=rows)
+
+    schema = pq.read_schema(_get_partition(version, 0))
+    buckets = _get_buckets(filters, partitions, schema.field('project').type if 'project' in schema.names else None)
+    dataset = pds.dataset([_get_partition(version, i) for i in range(partitions) if buckets is None or i in buckets], format='parquet')
+    for batch in dataset.to_batches(columns=columns, filter=pq.filters_to_expression(filters) if filters else None,
+                                    batch_size=batch_size, fragment_readahead=READAHEAD, batch_readahead=READAHEAD,
+                                    use_threads=True):
+        if batch.num_rows:
+            yield _to_pandas(_drop_index(pa.Table.from_batches([batch])), dtype_backend)
+
+def get_deduped_df_iter(filename: str, subdir: Optional[str]=None, dupesdir: Optional[str]=None, drop: Optional[List[str]]=None, ts: bool=False, columns: Optional[List[str]]=None, filters: Optional[Filters]=None, batch_size: int=BATCH_SIZE, partitions: int=PARTITIONS, dtype_backend: Optional[str]=None, **kwargs) -> Iterator[pd.DataFrame]:
+    '''Loads a CSV file in batches like get_df_iter(), and de-duplicates each
+    batch like get_deduped_df().  Batches can have fewer than 'batch_size'
+    rows, or none.
+
+    Returns:
+        Iterator[pd.DataFrame]: the de-duplicated CSV file, in batches
+    '''
+    names = ['var', 'hash', 'project', 'ts', 'file'] if ts else ['var', 'hash', 'project', 'file']
+    # de-duplicating needs the project and file of each row
+    needed = columns if columns is None else list(columns) + [c for c in ['project', 'file'] if c not in columns]
+    for df in get_df_iter(filename, subdir, drop, needed, filters, batch_size, partitions, dtype_backend, **kwargs):
+        df = _remove_dupes(df, dupesdir, names=names)
+        yield df if columns is None else df[list(columns)]
+
+def _get_partition(cache: str, i: int) -> str:
+    return os.path.join(cache, f'part-{i:05d}.parquet')
+
+def _get_bucket(values: Union[pa.Array, pa.ChunkedArray], partitions: int) -> np.ndarray:
+    '''Gets the partition each project is in, from a hash of its name.'''
+    values = pc.cast(values, pa.string()).to_numpy(zero_copy_only=False).astype(object)
+    return (pd.util.hash_array(values) % np.uint64(partitions)).astype(np.int64)
+
+def _get_buckets(filters: Optional[Filters], partitions: int, type: Optional[pa.DataType]) -> Optional[Set[int]]:
+    '''Gets the only partitions that can have rows matching the filters, or
+    None if they do not limit which projects match.
+
+    The projects in the filters are converted to the type of the 'project'
+    column first, so they hash like the values they match (e.g., 1 and 1.0).
+    '''
+    if not filters or type is None:
+        return None
+    buckets = set()
+    for conjunction in (filters if isinstance(filters[0], list) else [filters]):
+        projects = None
+        for column, op, value in conjunction:
+            if column == 'project' and op in ('=', '=='):
+                projects = [value]
+            elif column == 'project' and op == 'in':
+                projects = list(value)
+        if projects is None:
+            return None
+        try:
+            projects = pa.array(projects).cast(type)
+        except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError):
+            return None
+        buckets.update(_get_bucket(projects, partitions).tolist())
+    return buckets
+
+def _iter_source(inputs: Dict[str, Optional[str]], drop: Optional[List[str]], kwargs: Dict[str, Any], batch_size: int) -> Iterator[pa.RecordBatch]:
+    '''Reads the file get_df() would read a table from in batches, without
+    reading all of it into memory.'''
+    options = None
+    strings = set()
+    if inputs['sidecar'] is not None:
+        options = _typed_csv_options(inputs['csv'], inputs['sidecar'], kwargs.get('names'))
+
+    if inputs['source'] is not None:
+        batches = pq.ParquetFile(inputs['source']).iter_batches(batch_size)
+        if 'names' in kwargs:
+            batches = (pa.RecordBatch.from_arrays(batch.columns, names=kwargs['names']) for batch in batches)
+    elif options is not None:
+        batches = pcsv.open_csv(inputs['csv'], read_options=options[0], convert_options=options[1])
+    else:
+        # Pandas infers the types of each chunk on its own, so columns it
+        # infers different types for are read as a type all chunks fit
+        dtypes = _get_chunk_dtypes(inputs['csv'], kwargs, batch_size)
+        if dtypes:
+            kwargs = dict(kwargs, dtype={**(kwargs.get('dtype') or {}), **dtypes})
+        batches = (pa.RecordBatch.from_pandas(chunk, preserve_index=False)
+                   for chunk in pd.read_csv(inputs['csv'], index_col=False, chunksize=batch_size, **kwargs))
+        strings = {str(column) for column, dtype in dtypes.items() if dtype is str}
+
+    schema = None
+    for batch in batches:
+        if drop:
+            batch = batch.select([c for c in batch.schema.names if c not in drop])
+        if schema is None:
+            # a chunk with only missing values in a string column has no type
+            schema = pa.schema([pa.field(f.name, pa.string()) if f.name in strings else f for f in batch.schema], metadata=batch.schema.metadata)
+        # RecordBatch.cast() needs pyarrow 16, so the columns are cast one by one
+        yield pa.RecordBatch.from_arrays([column.cast(f.type) for column, f in zip(batch.columns, schema)], schema=schema)
+
+def _get_chunk_dtypes(csv: str, kwargs: Dict[str, Any], batch_size: int) -> Dict[Any, Any]:
+    '''Finds the columns Pandas infers different types for in different
+    chunks of a CSV file, e.g. numbers in one chunk and strings in another.
+
+    Returns:
+        Dict[Any, Any]: the type to read each of them as: floats if every chunk had numbers, and strings otherwise
+    '''
+    seen = collections.defaultdict(set)
+    for chunk in pd.read_csv(csv, index_col=False, chunksize=batch_size, **kwargs):
+        for column, dtype in chunk.dtypes.items():
+            seen[column].add(dtype)
+    return {column: np.float64 if all(dtype.kind in 'iuf' for dtype in dtypes) else str
+            for column, dtypes in seen.items() if len(dtypes) > 1}
+
+def _write_dataset(batches: Iterator[pa.RecordBatch], cache: str, fingerprint: Dict[str, Any], partitions: int) -> Tuple[int, str]:
+    '''Writes batches to a partitioned cache, with each batch's rows split
+    between the partitions by project.  At most a row group of rows is kept
+    in memory for each partition.
+
+    The cache is a link to a directory with the version of the table, e.g.
+    'rq1.parts' to 'rq1.v123-456.parts'.  Each build writes a new version,
+    then switches the link to it in one rename, so readers never find the
+    cache missing, and builds at the same time do not fail.
+
+    Returns:
+        Tuple[int, str]: the number of rows written, and the version written
+    '''
+    options = _get_write_options()
+    base, ext = os.path.splitext(cache)
+    tmp = f'{base}.v{os.getpid()}-{time.time_ns()}{ext}'
+    os.makedirs(tmp, 0o755, True)
+    writers = [None] * partitions
+    pending = [[] for _ in range(partitions)]
+    pending_rows = [0] * partitions
+    schema = None
+    rows = 0
+
+    def flush(i: int, final: bool):
+        table = pa.Table.from_batches(pending[i], schema=schema)
+        if writers[i] is None:
+            writers[i] = pq.ParquetWriter(_get_partition(tmp, i), schema, write_statistics=True, **options)
+        # keep any partial row group for the next write
+        size = table.num_rows if final else table.num_rows - table.num_rows % CACHE_ROW_GROUP_SIZE
+        if size:
+            writers[i].write_table(table.slice(0, size), row_group_size=CACHE_ROW_GROUP_SIZE)
+        pending[i] = table.slice(size).to_batches()
+        pending_rows[i] = table.num_rows - size
+
     try:
-        df = pd.read_parquet(_resolve_dir(f'data/parquet/{_get_dir(subdir)}{filename}-deduped.parquet'))
-    except:
-        if ts:
-            df = _remove_dupes(get_df(filename, subdir, drop, precache_function, **kwargs), dupesdir, names=['var', 'hash', 'project', 'ts', 'file'])
-        else:
-            df = _remove_dupes(get_df(filename, subdir, drop, precache_function, **kwargs), dupesdir)
-        os.makedirs(_resolve_dir(f'data/parquet/{_get_dir(subdir)}'), 0o755, True)
-        df.to_parquet(_resolve_dir(f'data/parquet/{_get_dir(subdir)}{filename}-deduped.parquet'), compression='gzip')
-    return df
+        for n, batch in enumerate(batches):
+            if schema is None:
+                metadata = dict(batch.schema.metadata or {})
+                metadata[FINGERPRINT_KEY] = json.dumps(fingerprint)
+                schema = batch.schema.with_metadata(metadata)
+            batch = pa.RecordBatch.from_arrays(batch.columns, schema=schema)
+            rows += batch.num_rows
+
+            if 'project' in schema.names:
+                bucket = _get_bucket(batch.column('project'), partitions)
+            else:
+                # without projects, batches are spread over the partitions in turn
+                bucket = np.full(batch.num_rows, n % partitions)
+            order = np.argsort(bucket, kind='stable')
+            offsets = np.concatenate([[0], np.cumsum(np.bincount(bucket, minlength=partitions))])
+            batch = batch.take(pa.array(order))
+            for i in range(partitions):
+                if offsets[i + 1] > offsets[i]:
+                    pending[i].append(batch.slice(offsets[i], offsets[i + 1] - offsets[i]))
+                    pending_rows[i] += offsets[i + 1] - offsets[i]
+                    if pending_rows[i] >= CACHE_ROW_GROUP_SIZE:
+                        flush(i, False)
+
+        if schema is None:
+            schema = pa.schema([], metadata={FINGERPRINT_KEY: json.dumps(fingerprint)})
+        # every partition gets a file, even if it is empty
+        for i in range(partitions):
+            flush(i, True)
+            writers[i].close()
+    except BaseException:
+        for writer in writers:
+            if writer is not None:
+                writer.close()
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+
+    replaced = os.path.realpath(cache) if os.path.islink(cache) else None
+    if os.path.isdir(cache) and not os.path.islink(cache):
+        # a cache written before caches were versioned
+        shutil.rmtree(cache, ignore_errors=True)
+    link = f'{cache}.{os.getpid()}.tmp'
+    os.symlink(os.path.basename(tmp), link)
+    os.replace(link, cache)
+
+    # the version just replaced is kept until the next build, for readers
+    # still using it, and versions of other running processes may be builds
+    keep = {os.path.realpath(tmp), replaced, os.path.realpath(cache)}
+    prefix = f'{os.path.basename(base)}.v'
+    for version in glob.glob(f'{glob.escape(base)}.v*-*{ext}'):
+        pid = os.path.basename(version)[len(prefix):-len(ext)].split('-')[0]
+        if not pid.isdigit() or os.path.realpath(version) in keep:
+            continue
+        if int(pid) == os.getpid() or not _is_running(int(pid)):
+            shutil.rmtree(version, ignore_errors=True)
+    return rows, tmp
+
+def _is_running(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
 
 def _remove_dupes(df: pd.DataFrame, dupesdir: Optional[str]=None, names=['var', 'hash', 'project', 'file']) -> pd.DataFrame:
-    df2 = get_df('dupes', dupesdir, names=names).drop(columns=['var'])
+    files, keys = _get_dupe_keys(dupesdir, names)
+
+    # only rows with the file name of a duplicate need their keys hashed
+    file = pa.array(df['file'] if pd.api.types.is_string_dtype(df['file']) else df['file'].astype(str), from_pandas=True)
+    candidates = np.flatnonzero(pc.is_in(file, value_set=files.cast(file.type)).to_numpy(zero_copy_only=False))
+    keep = np.ones(len(df), dtype=bool)
+    keep[candidates[np.isin(_hash_keys(df.iloc[candidates]), keys)]] = False
+    return df[keep]
+
+def _hash_keys(df: pd.DataFrame) -> np.ndarray:
+    '''Hashes each row's 'project' and 'file' into one int64 key.
+
+    Columns are hashed as strings, so the keys match no matter if a column
+    was read as strings or numbers.
+    '''
+    columns = pd.DataFrame({c: df[c] if pd.api.types.is_string_dtype(df[c]) else df[c].astype(str) for c in ['project', 'file']}, copy=False)
+    return pd.util.hash_pandas_object(columns, index=False).to_numpy().view(np.int64)
+
+# the dupes to drop for each dupes file, and the fingerprint they were found with
+_dupe_keys = {}
+
+def _get_dupes_source(dupesdir: Optional[str]=None) -> str:
+    '''Gets the dupes index in 'dupesdir', or the dupes CSV if there is no index.'''
+    index = _resolve_dir(f'data/csv/{_get_dir(dupesdir)}dupes-index.parquet')
+    return index if os.path.exists(index) else _resolve_dir(f'data/csv/{_get_dir(dupesdir)}dupes.csv')
+
+def _get_dupe_keys(dupesdir: Optional[str]=None, names=['var', 'hash', 'project', 'file']) -> Tuple[pa.Array, np.ndarray]:
+    '''Gets the duplicate files to drop, i.e. all but the first of each
+    group of files with the same hash.
+
+    They are found once per dupes file, and cached both in memory and in
+    'data/parquet/<dupesdir>/dupes-keys.parquet'.  Either cache is rebuilt
+    if the dupes file changed since, or 'names' is different.
+
+    Returns:
+        Tuple[pa.Array, np.ndarray]: the unique file names, and the sorted, unique hashed keys (see _hash_keys()) of the dupes
+    '''
+    source = _get_dupes_source(dupesdir)
+    cache = _resolve_dir(f'data/parquet/{_get_dir(dupesdir)}dupes-keys.parquet')
+    fingerprint = _fingerprint([source], names=names)
+
+    if cache in _dupe_keys and _fingerprint_matches(_dupe_keys[cache][0], fingerprint):
+        return _dupe_keys[cache][1]
+
+    start = time.perf_counter()
+    recorded = _read_fingerprint(cache, fingerprint)
+    if recorded is not None:
+        table = pq.read_table(cache)
+        fingerprint = recorded
+        _record_metric('parquet-load', f'{_get_dir(dupesdir)}dupes-keys', time.perf_counter() - start, rows=table.num_rows)
+    else:
+        fingerprint = _record_inputs(fingerprint)
+        if source.endswith('.parquet'):
+            # the index only has duplicated hashes, and the copy to keep comes first
+            df2 = pd.read_parquet(source, columns=['hash', 'project', 'file'])
+        else:
+            df2 = _to_pandas(_get_table('dupes', dupesdir, None, None, None, None, {'names': names}, memo=False))
+        df2 = df2[df2.duplicated(subset=['hash'])]
+        keys, first = np.unique(_hash_keys(df2), return_index=True)
+        file = df2['file'].iloc[first]
+        table = pa.table({'key': keys, 'file': pa.array(file if pd.api.types.is_string_dtype(file) else file.astype(str), pa.string(), from_pandas=True)})
+        _write_cache(table, cache, fingerprint)
+        _record_metric('parquet-build', f'{_get_dir(dupesdir)}dupes-keys', time.perf_counter() - start, rows=table.num_rows)
+
+    dupes = (pc.unique(table.column('file')),
+             table.column('key').to_numpy())
+    _dupe_keys[cache] = (fingerprint, dupes)
+    return dupes
+
+def _fingerprint(inputs: List[str], **options: Any) -> Dict[str, Any]:
+    '''Fingerprints a cached table: the input files it is made from, and
+    any other options it depends on.  The inputs are only stat'd and hashed
+    by _record_inputs(), right before the table is built.
+
+    Functions (e.g., a precache_function) are fingerprinted by a hash of
+    their code, so editing one rebuilds the tables it made.
+    '''
+    return {
+        'version': FINGERPRINT_VERSION,
+        'inputs': {path: None for path in inputs},
+        'options': json.loads(json.dumps(options, sort_keys=True, default=_normalize_option)),
+    }
+
+def _normalize_option(value: Any) -> Any:
+    if isinstance(value, functools.partial):
+        return {'partial': _normalize_option(value.func), 'args': value.args, 'keywords': value.keywords}
+    if callable(value) and hasattr(value, '__code__'):
+        h = hashlib.md5()
+        _hash_code(value.__code__, h)
+        h.update(repr(getattr(value, '__defaults__', None)).encode('utf-8'))
+        return {'function': getattr(value, '__qualname__', ''), 'code': h.hexdigest()}
+    if isinstance(value, (set, frozenset)):
+        return sorted(value, key=repr)
+    return repr(value)
+
+def _hash_code(code: types.CodeType, h: Any):
+    h.update(code.co_code)
+    h.update(repr(code.co_names).encode('utf-8'))
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            _hash_code(const, h)
+        else:
+            h.update(repr(const).encode('utf-8'))
+
+def _stat_input(path: str, digest: bool=True) -> Optional[List[Any]]:
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    if not digest:
+        return [st.st_size, st.st_mtime_ns]
+
+    key = os.path.abspath(path)
+    known = _get_digests().get(key)
+    if known is not None and known[:2] == [st.st_size, st.st_mtime_ns]:
+        return known
+
+    h = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(chunk)
+    stat = [st.st_size, st.st_mtime_ns, h.hexdigest()]
+    _save_digest(key, stat)
+    return stat
 
-    df2 = df2[df2.duplicated(subset=['hash'])]
-    df3 = pd.merge(df, df2, how='left', left_on=['project', 'file'], right_on=['project', 'file'])
-    # df4 consists of rows in df3 where 'hash' is 'NaN' (meaning that they did not exist in df2.duplicated(subset=['hash']))
-    df4 = df3[pd.isnull(df3['hash'])]
-    return df4.drop(columns=['hash'])
+# the size, modification time and MD5 hash each input was last hashed at, so
+# an input that is only touched (e.g., by make) is hashed once, not on every load
+_digests = None
+
+def _get_digests() -> Dict[str, List[Any]]:
+    global _digests
+    if _digests is None:
+        _digests = _read_digests()
+    return _digests
+
+def _read_digests() -> Dict[str, List[Any]]:
+    try:
+        with open(_resolve_dir(DIGESTS)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def _save_digest(key: str, stat: List[Any]):
+    '''Records an input's hash, keeping the ones other processes recorded.'''
+    global _digests
+    _digests = dict(_read_digests(), **_get_digests())
+    _digests[key] = stat
+
+    digests = _resolve_dir(DIGESTS)
+    tmp = f'{digests}.{os.getpid()}.tmp'
+    try:
+        os.makedirs(os.path.dirname(digests) or '.', 0o755, True)
+        with open(tmp, 'w') as f:
+            json.dump(_digests, f)
+        os.replace(tmp, digests)
+    except OSError:
+        pass
+
+def _record_inputs(fingerprint: Dict[str, Any]) -> Dict[str, Any]:
+    '''Fills in the size, modification time and MD5 hash of each input.'''
+    return dict(fingerprint, inputs={path: _stat_input(path) for path in fingerprint['inputs']})
+
+def _fingerprint_matches(recorded: Dict[str, Any], fingerprint: Dict[str, Any]) -> bool:
+    '''Checks if a recorded fingerprint still matches.  An input whose
+    modification time changed still matches if its contents did not.
+
+    An input that no longer exists also matches, so a cache can be used
+    without the files it was made from (e.g., one from data-cache.zip).  An
+    input that did not exist when the cache was built does not match.
+    '''
+    if recorded.get('version') != fingerprint['version'] or recorded.get('options') != fingerprint['options']:
+        return False
+    inputs = recorded.get('inputs', {})
+    for path in set(inputs) | set(fingerprint['inputs']):
+        current = _stat_input(path, False)
+        stat = inputs.get(path)
+        if current is None:
+            continue
+        if stat is None:
+            return False
+        if current[0] != stat[0] or (current[1] != stat[1] and _stat_input(path)[2] != stat[2]):
+            return False
+    return True
+
+def _read_fingerprint(cache: str, fingerprint: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    '''Gets the fingerprint recorded in a cached table, if it still matches.'''
+    try:
+        recorded = json.loads(pq.read_schema(cache).metadata[FINGERPRINT_KEY])
+    except (OSError, pa.ArrowInvalid, KeyError, TypeError, ValueError):
+        return None
+    return recorded if _fingerprint_matches(recorded, fingerprint) else None
+
+def _read_cache(cache: str, fingerprint: Dict[str, Any], columns: Optional[List[str]]=None, filters: Optional[Filters]=None) -> Tuple[Optional[pa.Table], Optional[Dict[str, Any]]]:
+    '''Loads (some columns and rows of) a cached table, unless it is missing
+    or its fingerprint does not match.
+
+    Returns:
+        Tuple[Optional[pa.Table], Optional[Dict[str, Any]]]: the table and the fingerprint recorded with it, or (None, None)
+    '''
+    recorded = _read_fingerprint(cache, fingerprint)
+    if recorded is None:
+        return None, None
+    try:
+        return pq.read_pandas(cache, columns=columns, filters=filters), recorded
+    except (OSError, pa.ArrowInvalid):
+        return None, None
+
+# tables already loaded, least recently used first, with their fingerprints
+_memo = collections.OrderedDict()
+_memo_bytes = 0
+
+def _memo_key(cache: str, fingerprint: Dict[str, Any], columns: Optional[List[str]], filters: Optional[Filters]) -> str:
+    return json.dumps([cache, fingerprint, columns, filters], sort_keys=True, default=_normalize_option)
+
+def _memo_get(key: str, fingerprint: Dict[str, Any]) -> Optional[pa.Table]:
+    '''Gets a table that was already loaded, if its inputs did not change since.
+
+    Arrow tables are immutable, so callers can share them, and get their own
+    DataFrame when converting them.'''
+    if key not in _memo:
+        return None
+    recorded, table = _memo[key]
+    if not _fingerprint_matches(recorded, fingerprint):
+        _memo_discard(key)
+        return None
+    _memo.move_to_end(key)
+    return table
+
+def _memo_put(key: str, fingerprint: Dict[str, Any], table: pa.Table):
+    '''Keeps a loaded table, dropping the least recently used ones to stay
+    under MEMO_BYTES.'''
+    global _memo_bytes
+    _memo_discard(key)
+    if table.nbytes > MEMO_BYTES:
+        return
+    _memo[key] = (fingerprint, table)
+    _memo_bytes += table.nbytes
+    while _memo_bytes > MEMO_BYTES:
+        _memo_discard(next(iter(_memo)))
+
+def _memo_discard(key: str):
+    global _memo_bytes
+    if key in _memo:
+        _memo_bytes -= _memo.pop(key)[1].nbytes
+
+def _select(table: pa.Table, columns: Optional[List[str]]=None, filters: Optional[Filters]=None) -> pa.Table:
+    '''Selects columns and rows of a table like the Parquet reader does,
+    keeping any index columns.'''
+    if filters:
+        table = table.filter(pq.filters_to_expression(filters))
+    if columns is not None:
+        index = [c for c in (table.schema.pandas_metadata or {}).get('index_columns', []) if isinstance(c, str)]
+        table = table.select(list(columns) + [c for c in index if c not in columns])
+    return table
+
+def _drop_index(table: pa.Table) -> pa.Table:
+    '''Drops the columns that hold a Pandas index, and the metadata only the cache needs.'''
+    index = [c for c in (table.schema.pandas_metadata or {}).get('index_columns', []) if isinstance(c, str)]
+    metadata = {k: v for k, v in (table.schema.metadata or {}).items() if k not in (b'pandas', FINGERPRINT_KEY)}
+    return table.select([c for c in table.schema.names if c not in index]).replace_schema_metadata(metadata)
+
+def _to_pandas(table: pa.Table, dtype_backend: Optional[str]=None) -> pd.DataFrame:
+    if dtype_backend is None:
+        return table.to_pandas()
+    if dtype_backend == 'pyarrow':
+        return table.to_pandas(types_mapper=pd.ArrowDtype)
+    raise ValueError(f'Unknown dtype_backend "{dtype_backend}", expected "pyarrow" or None')
+
+def _write_cache(df: Union[pd.DataFrame, pa.Table], cache: str, fingerprint: Dict[str, Any]) -> pa.Table:
+    '''Writes a cached table with its fingerprint, compressed as the study's
+    'cache' settings ask.  The table is written under a temporary name
+    first, so other processes never read a partial file.
+
+    Returns:
+        pa.Table: the table as written
+    '''
+    table = df if isinstance(df, pa.Table) else pa.Table.from_pandas(df)
+    metadata = dict(table.schema.metadata or {})
+    metadata[FINGERPRINT_KEY] = json.dumps(fingerprint)
+    table = table.replace_schema_metadata(metadata)
+
+    os.makedirs(os.path.dirname(cache) or '.', 0o755, True)
+    tmp = f'{cache}.{os.getpid()}.tmp'
+    try:
+        pq.write_table(table, tmp, row_group_size=CACHE_ROW_GROUP_SIZE, write_statistics=True, **_get_write_options())
+        os.replace(tmp, cache)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+    return table
+
+def _get_write_options() -> Dict[str, Any]:
+    '''Gets the Parquet writer options for caches, compressed as the study's
+    'cache' settings ask.
+
+    Parquet dictionary-encodes every column by default, which keeps the
+    repetitive project and file names small.
+    '''
+    compression, level = _get_cache_compression()
+    options = {'compression': compression or 'none'}
+    if level is not None and compression and pa.Codec.supports_compression_level(compression):
+        options['compression_level'] = level
+    return options
@@ -1,16 +1,23 @@
 # coding: utf-8
 
+import importlib.util
 import json
 import os
-from typing import Optional
+import sys
+from typing import Any, Optional, Tuple
 
 
 __all__ = [
     '_resolve_dir',
     '_get_dir',
+    '_record_metric',
+    '_get_cache_compression',
     'get_dataset',
 ]
 
+# the default codec for get_df()'s caches, see benchmarks/parquet-codecs.py
+CACHE_COMPRESSION = 'zstd'
+
 def _resolve_dir(dir: str) -> str:
     curdir = os.getcwd()
     if curdir.endswith('/analyses'):
@@ -32,3 +39,41 @@ def get_dataset(filename: str, subdir: Optional[str]=None) -> str:
     query = queries[f'{_get_dir(subdir)}{filename}.txt']
 
     return datasets[query['dataset']]
+
+def _get_cache_compression() -> Tuple[Optional[str], Optional[int]]:
+    '''Gets the Parquet codec and level the study's 'cache' settings ask for,
+    defaulting to zstd at its default level.'''
+    try:
+        with open(_resolve_dir('study-config.json')) as f:
+            cache = json.load(f).get('cache', {})
+    except (OSError, ValueError):
+        cache = {}
+
+    compression = cache.get('compression', CACHE_COMPRESSION)
+    if compression == 'none':
+        return None, None
+    return compression, cache.get('level')
+
+def _load_utilities() -> Any:
+    '''Loads bin/utilities.py by its path, so the bin/ scripts do not shadow
+    modules analyses import.  bin/run-analyses.py already has it loaded.'''
+    path = os.path.realpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'bin', 'utilities.py'))
+    for name in ['utilities', '_boa_utilities']:
+        module = sys.modules.get(name)
+        if module is not None and os.path.realpath(getattr(module, '__file__', '') or '') == path:
+            return module
+
+    spec = importlib.util.spec_from_file_location('_boa_utilities', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    sys.modules['_boa_utilities'] = module
+    return module
+
+# metrics are written by the same code as the build scripts in bin/
+utilities = _load_utilities()
+
+def _record_metric(stage: str, target: str, seconds: float, **values: Any):
+    metrics_file = utilities.METRICS_JSONL
+    if metrics_file and not os.path.isabs(metrics_file):
+        metrics_file = _resolve_dir(metrics_file)
+    utilities.record_metric(stage, target, seconds, metrics_file=metrics_file, **values)
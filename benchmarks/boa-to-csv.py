@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+'''Benchmarks the block-based Boa to CSV converter against the previous
+line-by-line implementation on generated Boa output, and checks that both
+produce identical CSV.  Includes file names with many '][' for column tests,
+which used to take quadratic time per line.'''
+
+import io
+import os
+import random
+import re
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'bin'))
+from boaio import open_output
+from boaparse import WRITE_BUFFER_SIZE, BoaCsvConverter, convert_file, parse_tests
+
+
+def legacy_boa_to_csv(f, out, pbar, numidx=None, drop=None, tests=None, header=None):
+    # the original loop from bin/boa-to-csv.py, except that blank lines are
+    # skipped instead of looping forever
+    drop = drop or []
+    test = []
+    ext = {}
+    for x in tests or []:
+        xs = x.split(',')
+        test.append(int(xs[0]))
+        ext[int(xs[0])] = xs[1]
+
+    if header is not None:
+        print(header, file=out)
+
+    s = f.readline()
+    while s is not None and len(s) > 0:
+        if pbar is not None:
+            pbar.update(len(s))
+
+        if len(s.strip()) == 0:
+            s = f.readline()
+            continue
+
+        s = s[:-1].replace('\\n', '\\\\n').replace('"', '""')
+        parts = []
+
+        cur = 0
+        idx = s.find('[', cur)
+        if idx > -1:
+            parts.append('"' + s[cur:idx] + '"')
+            cur = idx + 1
+
+            idx = s.find('][', cur)
+            while idx > -1 and idx < len(s) and (numidx is None or len(parts) < numidx):
+                if len(parts) in test:
+                    while idx > -1 and idx < len(s) and not re.search(ext[len(parts)], s[cur:idx].lower()):
+                        idx = s.find('][', idx + 2)
+                    if idx == -1 or idx == len(s):
+                        break
+                parts.append('"' + s[cur:idx] + '"')
+                cur = idx + 2
+                idx = s.find('][', cur)
+
+        if numidx is None:
+            numidx = len(parts)
+
+        idx = s.find('] = ', cur)
+        if idx > -1:
+            parts.append('"' + s[cur:idx] + '"')
+            cur = idx + 1
+
+        idx = s.find(' = ', cur)
+        if idx > -1:
+            parts.append('"' + s[idx + 3:] + '"')
+
+        parts2 = [x for i, x in enumerate(parts) if i not in drop]
+        print(','.join(parts2), file=out)
+        s = f.readline()
+
+
+def random_name(rng, odd):
+    name = rng.choice(['alice/project', 'bob/lib-utils', 'carol/app', 'dave/kotlin-stdlib'])
+    name += '/' + '/'.join(rng.choice(['src', 'main', 'kotlin', 'test', 'java', 'util']) for _ in range(rng.randint(1, 5)))
+    name += '/' + rng.choice(['Main', 'Foo', 'BarTest', 'build.gradle']) + rng.choice(['.kt', '.kts', '.java', '.py'])
+    if rng.random() < odd:
+        # the awkward characters Boa does not escape
+        name = rng.choice(['[', ']', '][', '"', '\\n', ' = ', '] = ']).join([name[:5], name[5:]])
+    return name
+
+
+def generate(rng, lines, odd):
+    out = []
+    for _ in range(lines):
+        out.append(f'counts[{random_name(rng, odd)}][{random_name(rng, odd)}][{rng.randint(0, 10 ** 9)}] = {rng.randint(0, 10 ** 4)}\n')
+    return ''.join(out)
+
+
+def generate_adversarial(rng, lines, brackets):
+    # file names made of many '][' separated parts, which a column test has to
+    # try one at a time, and some that never pass the test at all
+    out = []
+    for _ in range(lines):
+        name = ']['.join(rng.choice(['src', 'Main', 'a.b', 'x']) for _ in range(brackets))
+        name += rng.choice(['.kt', '.kts', '.java'])
+        out.append(f'counts[{name}][{random_name(rng, 0)}][{rng.randint(0, 10 ** 9)}] = {rng.randint(0, 10 ** 4)}\n')
+    return ''.join(out)
+
+
+def progress_bar(filename):
+    try:
+        from tqdm import tqdm
+        return tqdm(total=os.path.getsize(filename), file=open(os.devnull, 'w'))
+    except ImportError:
+        return None
+
+
+def run_legacy(filename, output, options):
+    pbar = progress_bar(filename)
+    with open(filename, encoding='utf-8') as f, open(output, 'w', encoding='utf-8') as out:
+        legacy_boa_to_csv(f, out, pbar, **options)
+
+
+def run_converter(filename, output, options):
+    pbar = progress_bar(filename)
+    converter = BoaCsvConverter(options.get('numidx'), options.get('drop'), parse_tests(options.get('tests')))
+    with open_output(filename, 'rb', progress=pbar.update if pbar is not None else None) as f, \
+            open(output, 'wb', buffering=WRITE_BUFFER_SIZE) as out:
+        convert_file(f, out, converter, options.get('header'))
+
+
+def bench(label, fn):
+    start = time.perf_counter()
+    result = fn()
+    elapsed = time.perf_counter() - start
+    print(f'  {label:<10} {elapsed:8.2f} s')
+    return result, elapsed
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+    parser = ArgumentParser()
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--lines', type=int, default=500000)
+    parser.add_argument('--adversarial-lines', type=int, default=500)
+    parser.add_argument('--brackets', type=int, default=2000,
+                        help='how many \'][\' each adversarial file name has')
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    tmp = tempfile.mkdtemp()
+    clean = os.path.join(tmp, 'clean.txt')
+    messy = os.path.join(tmp, 'messy.txt')
+    with open(clean, 'w', encoding='utf-8') as fh:
+        fh.write(generate(rng, args.lines, 0))
+    with open(messy, 'w', encoding='utf-8') as fh:
+        fh.write(generate(rng, args.lines, 0.05))
+    adversarial = os.path.join(tmp, 'adversarial.txt')
+    with open(adversarial, 'w', encoding='utf-8') as fh:
+        fh.write(generate_adversarial(rng, args.adversarial_lines, args.brackets))
+    expected = os.path.join(tmp, 'expected.csv')
+    actual = os.path.join(tmp, 'actual.csv')
+
+    cases = [
+        ('inferred indices', clean, args.lines, {}),
+        ('dropped column', clean, args.lines, {'drop': [1], 'header': '"var","file","ts","count"'}),
+        ('given indices', clean, args.lines, {'numidx': 2}),
+        ('unescaped characters', messy, args.lines, {}),
+        ('column test', messy, args.lines, {'tests': ['1,\\.(kts?|java|py|gradle)$']}),
+        ('adversarial column test', adversarial, args.adversarial_lines, {'numidx': 3, 'tests': ['1,\\.kts?$']}),
+    ]
+
+    failed = False
+    try:
+        for label, filename, lines, options in cases:
+            print(f'{label} ({lines} lines):')
+            _, legacy_time = bench('legacy', lambda: run_legacy(filename, expected, options))
+            _, new_time = bench('converter', lambda: run_converter(filename, actual, options))
+
+            with open(expected, 'rb') as fh1, open(actual, 'rb') as fh2:
+                if fh1.read() != fh2.read():
+                    print('  MISMATCH between legacy and new converter output')
+                    failed = True
+                    continue
+            print(f'  rows/s     {lines / new_time:8.0f}')
+            print(f'  speedup    {legacy_time / new_time:8.1f}x')
+    finally:
+        for filename in [clean, messy, adversarial, expected, actual]:
+            if os.path.exists(filename):
+                os.unlink(filename)
+        os.rmdir(tmp)
+
+    if failed:
+        sys.exit(1)
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+'''Benchmarks the template expander against the previous regex-based
+implementation on generated queries and snippets, and checks that both
+produce identical queries (so existing job hashes stay valid).  The legacy
+implementation is skipped for outputs above --legacy-limit characters.'''
+
+import os
+import random
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'bin'))
+from utilities import TemplateExpander
+
+
+def legacy_expand_replacements(replacements, query):
+    replacements = [(before, after.replace('\\', '#WHY#')) for (before, after) in replacements]
+    if len(replacements) > 0:
+        has_replaced = True
+        while has_replaced:
+            has_replaced = False
+            for (before, after) in replacements:
+                after = (r'\g<1>\g<2>' + after.strip()).replace('\n', '\n\\1') + r'\3'
+                before = re.sub(r'([{}])', r'\\\1', before)
+                replaced = re.sub(r'([ \t]*)(.*(?=' + before + '))' + before + '(\n?)',
+                                  after,
+                                  query).replace('#WHY#', '\\')
+                if query != replaced:
+                    has_replaced = True
+                    query = replaced
+    return query
+
+
+def random_line(rng, targets):
+    indent = ' ' * rng.choice([0, 0, 4, 8]) + '\t' * rng.choice([0, 0, 1])
+    words = [rng.choice(['x', 'foo(bar)', 'if (a > b)', '"\\n"', 'c := 0;', '#', '{', '}'])
+             for _ in range(rng.randint(1, 6))]
+    # some lines have several targets, possibly the same one twice
+    while targets and rng.random() < 0.3:
+        words.insert(rng.randint(0, len(words)), rng.choice(targets))
+    return indent + ' '.join(words)
+
+
+def generate(rng, num_snippets, snippet_lines, query_lines):
+    targets = [f'{{@snippet-{i}@}}' for i in range(num_snippets)]
+
+    replacements = []
+    for i, target in enumerate(targets):
+        # snippets may only refer to later snippets, so there are no cycles
+        lines = [random_line(rng, targets[i + 1:]) for _ in range(rng.randint(1, snippet_lines))]
+        replacements.append((target, '\n'.join(lines) + rng.choice(['', '\n', '  \n'])))
+
+    query = '\n'.join(random_line(rng, targets) for _ in range(query_lines)) + '\n'
+    return replacements, query
+
+
+def bench(label, fn, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = fn()
+    elapsed = (time.perf_counter() - start) / repeat
+    print(f'  {label:<10} {elapsed * 1000:10.2f} ms')
+    return result, elapsed
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+    parser = ArgumentParser()
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--legacy-limit', type=int, default=100_000,
+                        help='skip the legacy implementation for outputs longer than this')
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+
+    for (num_snippets, snippet_lines, query_lines) in [(5, 5, 100), (10, 5, 500), (20, 10, 1000), (40, 10, 2000)]:
+        replacements, query = generate(rng, num_snippets, snippet_lines, query_lines)
+        print(f'{num_snippets} snippets, up to {snippet_lines} lines each, {query_lines} query lines:')
+
+        actual, new_time = bench('expander', lambda: TemplateExpander(replacements).expand(query), args.repeat)
+        # the legacy implementation takes minutes on outputs of a few MB
+        if len(actual) > args.legacy_limit:
+            print(f'  legacy     skipped ({len(actual)} characters of output)')
+            continue
+        expected, legacy_time = bench('legacy', lambda: legacy_expand_replacements(replacements, query), args.repeat)
+
+        if actual != expected:
+            print('  MISMATCH between legacy and new expander output')
+            sys.exit(1)
+        print(f'  speedup    {legacy_time / new_time:10.1f}x')
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+'''Benchmarks get_df() and get_deduped_df() against the original
+implementation (pandas read_csv and a merge against the dupes file) on a
+generated study, and checks that both load the same tables, in the same
+order, keeping the same copy of each duplicated file.'''
+
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'analyses'))
+import common.df
+from common.df import get_df, get_deduped_df
+
+NAMES = ['var', 'project', 'file', 'astcount']
+
+
+def legacy_get_df(filename, subdir, **kwargs):
+    return pd.read_csv(f'data/csv/{subdir}/{filename}.csv', index_col=False, **kwargs)
+
+
+def legacy_get_deduped_df(filename, subdir, dupesdir, ts=False, **kwargs):
+    names = ['var', 'hash', 'project', 'ts', 'file'] if ts else ['var', 'hash', 'project', 'file']
+    df = legacy_get_df(filename, subdir, **kwargs)
+    df2 = legacy_get_df('dupes', dupesdir, names=names).drop(columns=['var'])
+    df2 = df2[df2.duplicated(subset=['hash'])]
+    df3 = pd.merge(df, df2, how='left', left_on=['project', 'file'], right_on=['project', 'file'])
+    df4 = df3[pd.isnull(df3['hash'])]
+    return df4.drop(columns=['hash'] + (['ts'] if ts else []))
+
+
+def random_name(rng, n):
+    # mixed widths, so string order differs from Boa's (e.g., p10 < p2)
+    return f'p{rng.randrange(n)}'
+
+
+def generate(rng, rows, projects, ts):
+    '''Writes an output with several files per project, in Boa's key order,
+    and a dupes file whose groups list their copies in no particular order.'''
+    os.makedirs('data/csv/kotlin', exist_ok=True)
+    files = []
+    with open('data/csv/kotlin/rq1.csv', 'w') as fh:
+        for p in sorted({random_name(rng, projects) for _ in range(projects)}, key=lambda p: int(p[1:])):
+            for _ in range(rng.randint(1, 2 * rows // projects)):
+                f = f'{rng.choice(["src", "test", "main"])}/{rng.choice("zyxabc")}{rng.randrange(100)}.kt'
+                files.append((p, f))
+                fh.write(f'counts,{p},{f},{rng.randrange(1000)}\n')
+
+    with open('data/csv/kotlin/dupes.csv', 'w') as fh:
+        # each file has one hash
+        files = list(dict.fromkeys(files))
+        rng.shuffle(files)
+        for h in range(len(files) // 4):
+            for p, f in files[h * 4:h * 4 + rng.randint(2, 4)]:
+                stamp = f',{rng.randrange(10 ** 9)}' if ts else ''
+                fh.write(f'dupes,{h},{p}{stamp},{f}\n')
+
+
+def bench(label, fn):
+    start = time.perf_counter()
+    result = fn()
+    elapsed = time.perf_counter() - start
+    print(f'  {label:<16} {elapsed * 1000:10.2f} ms')
+    return result
+
+
+def check(label, expected, actual):
+    try:
+        pd.testing.assert_frame_equal(expected, actual)
+    except AssertionError as e:
+        print(f'  MISMATCH in {label}: {e}')
+        return False
+    return True
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+    parser = ArgumentParser()
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--rows', type=int, default=200000)
+    parser.add_argument('--projects', type=int, default=2000)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    cwd = os.getcwd()
+    tmp = tempfile.mkdtemp()
+    ok = True
+    try:
+        os.chdir(tmp)
+        for ts in [False, True]:
+            generate(rng, args.rows, args.projects, ts)
+            shutil.rmtree('data/parquet', ignore_errors=True)
+            common.df._memo.clear()
+            common.df._memo_bytes = 0
+            common.df._dupe_keys.clear()
+            print(f'{args.rows} rows, {args.projects} projects{", with timestamps" if ts else ""}:')
+
+            expected = bench('legacy', lambda: legacy_get_df('rq1', 'kotlin', names=NAMES))
+            ok &= check('get_df', expected, bench('get_df build', lambda: get_df('rq1', 'kotlin', names=NAMES)))
+            ok &= check('get_df', expected, bench('get_df load', lambda: get_df('rq1', 'kotlin', names=NAMES)))
+
+            deduped = bench('legacy deduped', lambda: legacy_get_deduped_df('rq1', 'kotlin', 'kotlin', ts=ts, names=NAMES))
+            ok &= check('get_deduped_df', deduped, bench('deduped build', lambda: get_deduped_df('rq1', 'kotlin', 'kotlin', ts=ts, names=NAMES)))
+            ok &= check('get_deduped_df', deduped, bench('deduped load', lambda: get_deduped_df('rq1', 'kotlin', 'kotlin', ts=ts, names=NAMES)))
+
+            projects = sorted(set(expected['project']))[:5]
+            filtered = expected[expected['project'].isin(projects)].reset_index(drop=True)
+            ok &= check('filters', filtered, get_df('rq1', 'kotlin', names=NAMES, filters=[('project', 'in', projects)]).reset_index(drop=True))
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(tmp)
+    sys.exit(0 if ok else 1)
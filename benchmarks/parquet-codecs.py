@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+'''Benchmarks the Parquet codecs get_df() can cache tables with, on generated
+tables shaped like the study's (a query output with repetitive project and
+file names, and a dupes index), or on given Parquet/CSV files.  Reports the
+write time, read time and size of each codec, with and without dictionary
+encoding of every column, of just the string columns, or of none.'''
+
+import os
+import random
+import tempfile
+import time
+
+import pyarrow as pa
+import pyarrow.csv as pcsv
+import pyarrow.parquet as pq
+
+CODECS = ['gzip', 'snappy', 'zstd', 'lz4']
+
+
+def random_project(rng, projects):
+    return f'{rng.choice(["alice", "bob", "carol", "dave"])}/project-{rng.randrange(projects)}'
+
+
+def random_file(rng, project):
+    path = '/'.join(rng.choice(['src', 'main', 'kotlin', 'test', 'java', 'util']) for _ in range(rng.randint(1, 5)))
+    return f'{project}/{path}/{rng.choice(["Main", "Foo", "BarTest", "build.gradle"])}{rng.randrange(50)}{rng.choice([".kt", ".kts"])}'
+
+
+def generate_output(rng, rows, projects):
+    '''A table like 'rq1': var, project, file and a count, several rows per file.'''
+    project, file, count = [], [], []
+    while len(project) < rows:
+        p = random_project(rng, projects)
+        f = random_file(rng, p)
+        for _ in range(rng.randint(1, 8)):
+            project.append(p)
+            file.append(f)
+            count.append(rng.randrange(10 ** 4))
+    return pa.table({
+        'var': pa.array(['counts'] * rows),
+        'project': pa.array(project[:rows]),
+        'file': pa.array(file[:rows]),
+        'astcount': pa.array(count[:rows], pa.int64()),
+    })
+
+
+def generate_index(rng, rows, projects):
+    '''A table like a dupes index: groups of files sharing a hash.'''
+    hash, project, file, size = [], [], [], []
+    while len(hash) < rows:
+        h = rng.randrange(-2 ** 63, 2 ** 63)
+        n = rng.randint(2, 6)
+        for _ in range(n):
+            p = random_project(rng, projects)
+            hash.append(h)
+            project.append(p)
+            file.append(random_file(rng, p))
+            size.append(n)
+    return pa.table({
+        'hash': pa.array(hash[:rows], pa.int64()),
+        'project': pa.array(project[:rows]),
+        'file': pa.array(file[:rows]),
+        'ts': pa.nulls(rows, pa.int64()),
+        'size': pa.array(size[:rows], pa.int64()),
+    })
+
+
+def load(filename):
+    if filename.endswith('.csv'):
+        return pcsv.read_csv(filename)
+    return pq.read_table(filename)
+
+
+def string_columns(table):
+    return [f.name for f in table.schema if pa.types.is_string(f.type) or pa.types.is_large_string(f.type)]
+
+
+def bench(table, path, codec, level, dictionary, repeat):
+    options = {'compression': codec, 'use_dictionary': {'all': True, 'strings': string_columns(table), 'none': False}[dictionary]}
+    if level is not None and pa.Codec.supports_compression_level(codec):
+        options['compression_level'] = level
+    write = read = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        pq.write_table(table, path, **options)
+        write = min(write, time.perf_counter() - start)
+
+        start = time.perf_counter()
+        pq.read_table(path).to_pandas()
+        read = min(read, time.perf_counter() - start)
+    return write, read, os.path.getsize(path)
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+    parser = ArgumentParser()
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--rows', type=int, default=2000000)
+    parser.add_argument('--projects', type=int, default=5000)
+    parser.add_argument('--level', type=int, default=None,
+                        help='the compression level, for codecs that have levels (default: each codec\'s own)')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='runs per codec, of which the fastest is reported')
+    parser.add_argument('files', nargs='*',
+                        help='Parquet or CSV files to benchmark, instead of generated tables')
+    args = parser.parse_args()
+
+    if args.files:
+        tables = [(filename, load(filename)) for filename in args.files]
+    else:
+        rng = random.Random(args.seed)
+        tables = [
+            ('query output', generate_output(rng, args.rows, args.projects)),
+            ('dupes index', generate_index(rng, args.rows, args.projects)),
+        ]
+
+    tmp = tempfile.mkdtemp()
+    path = os.path.join(tmp, 'table.parquet')
+    try:
+        for label, table in tables:
+            print(f'{label} ({table.num_rows} rows, {table.nbytes / 2 ** 20:.1f} MB in memory):')
+            print(f'  {"codec":<8} {"dict":<8} {"write s":>8} {"read s":>8} {"MB":>8}')
+            for codec in CODECS:
+                if not pa.Codec.is_available(codec):
+                    print(f'  {codec:<8} not available')
+                    continue
+                for dictionary in ['all', 'strings', 'none']:
+                    write, read, size = bench(table, path, codec, args.level, dictionary, args.repeat)
+                    print(f'  {codec:<8} {dictionary:<8} {write:8.3f} {read:8.3f} {size / 2 ** 20:8.2f}')
+    finally:
+        if os.path.exists(path):
+            os.unlink(path)
+        os.rmdir(tmp)
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from download import check_job, finish_query, restore_query, submit_query, verifyDownload
+from functools import partial
+from pathlib import Path
+from polling import JobTimeout, record_phases, wait_for_job
+from utilities import *
+
+
+async def download_target(pool, config, target, job):
+    '''Downloads and verifies the output of a finished job.
+
+    All Boa API calls happen on the event loop's thread, since the client is
+    not thread-safe.  The worker thread only streams the output bytes.
+    '''
+    target_path = Path(TXT_ROOT, target)
+    logger.info(f'Downloading query output "{target_path}"...')
+
+    job.set_public(get_make_public(config, target))
+    url = get_output_url(job)
+    compression = get_compression(config, target)
+
+    target_path.parent.mkdir(parents=True, exist_ok=True)
+    try:
+        with Timer('download', target, job=job.id) as timer:
+            digest = await asyncio.get_running_loop().run_in_executor(
+                pool, partial(download_output, job, target_path, url, compression=compression))
+            timer.values['bytes'] = digest[0]
+    except Exception as e:
+        logger.error(f'Downloading output of {target} failed: {e}')
+        return False
+    return verifyDownload(target, digest)
+
+
+async def run_target(pool, config, target, job, hash, job_timeout):
+    try:
+        phases = await wait_for_job(job, job_timeout)
+    except JobTimeout as e:
+        logger.error(str(e))
+        logger.error(f'See url: {job.get_url()}')
+        return False
+    logger.debug(f'Job {job.id} is complete.')
+    record_phases(target, job, phases)
+
+    if check_job(job) != 0:
+        return False
+
+    finish_query(target, job.id, hash)
+    return await download_target(pool, config, target, job)
+
+
+async def run_batch(config, targets, max_downloads, timeout=None, job_timeout=None):
+    tasks = {}
+
+    with ThreadPoolExecutor(max_workers=max_downloads) as pool:
+        for target in targets:
+            if is_run_needed(config, target) and not restore_query(config, target):
+                logger.info(f'Submitting query for "{target}"...')
+                job, hash = submit_query(config, target)
+                tasks[target] = asyncio.create_task(run_target(pool, config, target, job, hash, job_timeout))
+            elif not verifyDownload(target):
+                job = get_client().get_job(get_query_data()[target]['job'])
+                tasks[target] = asyncio.create_task(download_target(pool, config, target, job))
+            else:
+                logger.debug(f'Output "{target}" is up to date.')
+
+        if not tasks:
+            return []
+
+        with Timer():
+            _, pending = await asyncio.wait(tasks.values(), timeout=timeout)
+        for task in pending:
+            task.cancel()
+
+    failures = []
+    for target, task in tasks.items():
+        if task in pending:
+            logger.error(f'Output {target} did not finish within the overall timeout of {timeout} seconds.')
+            failures.append(target)
+        elif task.exception() is not None:
+            logger.error(f'Output {target} failed: {task.exception()}')
+            failures.append(target)
+        elif not task.result():
+            failures.append(target)
+    return failures
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+    parser = ArgumentParser()
+    parser.add_argument('--verbose', '-v', action='count', default=0)
+    parser.add_argument('--downloads', '-j', type=int, default=4,
+                        help='maximum number of outputs to download at the same time')
+    parser.add_argument('--timeout', type=float, default=None,
+                        help='seconds to wait for all queries to finish before giving up')
+    parser.add_argument('--job-timeout', type=float, default=None,
+                        help='seconds to wait for any one Boa job before giving up on it')
+    parser.add_argument('targets', nargs='*',
+                        help='download targets to refresh (defaults to all queries in study-config.json)')
+    args = parser.parse_args()
+
+    verbosity = min(max(3 - args.verbose, 1), 3) * 10
+    logger.setLevel(verbosity)
+    logger.info(f'Setting verbosity to {verbosity}')
+
+    config = get_query_config()
+    targets = [x[len(TXT_ROOT):] if x.startswith(TXT_ROOT) else x for x in args.targets] or list(config['queries'])
+
+    for target in targets:
+        if target not in config['queries']:
+            print(f'The download target {target} is not in the study-config.json.')
+            exit(3)
+
+    failures = asyncio.run(run_batch(config, targets, args.downloads, args.timeout, args.job_timeout))
+
+    close_client()
+
+    if failures:
+        logger.error('The following outputs failed: ' + ', '.join(failures))
+        exit(23)
@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+import os
+import threading
+import time
+import xmlrpc.client
+from utilities import *
+
+# calls answered locally, so clients never log the shared session in or out
+LOCAL_CALLS = {
+    'user.login': lambda *args: {'token': ''},
+    'user.logout': lambda *args: None,
+}
+
+# calls whose results do not change for the life of the session
+CACHED_CALLS = {'boa.datasets'}
+
+
+class SessionBroker:
+    def __init__(self, server, idle_timeout):
+        self.server = server
+        self.idle_timeout = idle_timeout
+        self.lock = threading.Lock()
+        self.cache = {}
+        self.connections = 0
+        self.last_active = time.monotonic()
+        self.running = False
+
+    def shutdown(self):
+        self.running = False
+        # wake up the accept() in serve()
+        from multiprocessing.connection import Client
+        Client(SESSION_SOCKET, family='AF_UNIX').close()
+
+    def call(self, name, args):
+        if name in LOCAL_CALLS:
+            return LOCAL_CALLS[name](*args)
+        if name == 'session.shutdown':
+            logger.info('Shutdown requested.')
+            threading.Thread(target=self.shutdown, daemon=True).start()
+            return None
+
+        key = (name, args)
+        with self.lock:
+            if name in CACHED_CALLS and key in self.cache:
+                return self.cache[key]
+
+            method = self.server
+            for part in name.split('.'):
+                method = getattr(method, part)
+            result = method(*args)
+
+            if name in CACHED_CALLS:
+                self.cache[key] = result
+        return result
+
+    def handle(self, conn):
+        try:
+            with conn:
+                while True:
+                    try:
+                        name, args = conn.recv()
+                    except (EOFError, OSError):
+                        break
+
+                    self.last_active = time.monotonic()
+                    try:
+                        reply = (True, self.call(name, args))
+                    except xmlrpc.client.Fault as e:
+                        # Faults cannot be unpickled, so clients rebuild them
+                        reply = (False, (e.faultCode, e.faultString))
+                    except Exception as e:
+                        reply = (False, (type(e).__name__, str(e)))
+                    try:
+                        conn.send(reply)
+                    except Exception as e:
+                        logger.warning(f'Could not answer {name}: {e}')
+                        break
+        finally:
+            with self.lock:
+                self.connections -= 1
+                self.last_active = time.monotonic()
+
+    def watch_idle(self):
+        while self.running:
+            time.sleep(1)
+            if self.connections == 0 and time.monotonic() - self.last_active > self.idle_timeout:
+                logger.info(f'Idle for {self.idle_timeout} seconds, shutting down.')
+                self.shutdown()
+                return
+
+    def serve(self, listener):
+        self.running = True
+        if self.idle_timeout > 0:
+            threading.Thread(target=self.watch_idle, daemon=True).start()
+
+        while self.running:
+            try:
+                conn = listener.accept()
+            except OSError:
+                break
+            if not self.running:
+                conn.close()
+                break
+            with self.lock:
+                self.connections += 1
+            threading.Thread(target=self.handle, args=(conn,), daemon=True).start()
+
+
+def serve(args):
+    session = connect_session()
+    if session is not None:
+        print(f'A Boa session broker is already running at "{SESSION_SOCKET}".')
+        exit(0)
+    if os.path.exists(SESSION_SOCKET):
+        os.unlink(SESSION_SOCKET)
+
+    from boaapi.boa_client import BoaClient, BOA_API_ENDPOINT
+    from multiprocessing.connection import Listener
+
+    boa = BoaClient(endpoint=BOA_API_ENDPOINT)
+    boa.login(*get_credentials())
+
+    if args.background and os.fork() != 0:
+        # skip interpreter cleanup, which would close the child's connection
+        os._exit(0)
+
+    old_umask = os.umask(0o177)
+    try:
+        listener = Listener(SESSION_SOCKET, family='AF_UNIX')
+    finally:
+        os.umask(old_umask)
+
+    logger.info(f'Serving Boa session at "{SESSION_SOCKET}".')
+    try:
+        SessionBroker(boa.server, args.idle_timeout).serve(listener)
+    finally:
+        listener.close()
+        if os.path.exists(SESSION_SOCKET):
+            os.unlink(SESSION_SOCKET)
+        boa.close()
+
+
+def stop(args):
+    session = connect_session()
+    if session is None:
+        print('No Boa session broker is running.')
+        return
+
+    session.session.shutdown()
+    print(f'Stopped Boa session broker at "{SESSION_SOCKET}".')
+
+
+def status(args):
+    if connect_session() is None:
+        print('No Boa session broker is running.')
+        exit(1)
+    print(f'Boa session broker is running at "{SESSION_SOCKET}".')
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+    parser = ArgumentParser()
+    parser.add_argument('--verbose', '-v', action='count', default=0)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    serve_parser = subparsers.add_parser('serve', help='log in and serve the session until idle')
+    serve_parser.add_argument('--background', '-b', action='store_true',
+                              help='run in the background after logging in')
+    serve_parser.add_argument('--idle-timeout', type=int, default=1800,
+                              help='seconds without any requests before exiting (0 to never exit)')
+    serve_parser.set_defaults(func=serve)
+
+    subparsers.add_parser('stop', help='stop serving the session').set_defaults(func=stop)
+    subparsers.add_parser('status', help='check if a session is being served').set_defaults(func=status)
+
+    args = parser.parse_args()
+
+    verbosity = min(max(3 - args.verbose, 1), 3) * 10
+    logger.setLevel(verbosity)
+    logger.info(f'Setting verbosity to {verbosity}')
+
+    args.func(args)
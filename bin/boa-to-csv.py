@@ -3,7 +3,10 @@
 
 import argparse
 import os
-import re
+import sys
+from boaio import iter_output_blocks
+from boaparse import WRITE_BUFFER_SIZE, BoaCsvConverter, convert_blocks, convert_file_parallel, parse_tests
+from utilities import Timer, get_query_config, get_split_vars
 
 
 def valid_file(parser, arg):
@@ -27,10 +30,33 @@ if __name__ == '__main__':
     parser.add_argument('--header',
                         type=str,
                         help='a header row to prepend to the CSV output')
+    parser.add_argument('--column',
+                        '-c',
+                        action='append',
+                        type=str,
+                        help='the name of the next column (after dropping) in the schema sidecar, if not named by --header')
+    parser.add_argument('--type',
+                        action='append',
+                        type=str,
+                        help='a "column:type" pair declaring a column\'s type in the schema sidecar, instead of inferring it')
+    parser.add_argument('--schema',
+                        type=str,
+                        default=None,
+                        help='path to write a schema sidecar (column names and types) for the CSV to')
+    parser.add_argument('--split',
+                        type=str,
+                        metavar='TARGET',
+                        default=None,
+                        help='split the output into a table per output variable, as configured for the query TARGET (e.g., "kotlin/stats.txt") in study-config.json - the other conversion options and --jobs are ignored')
     parser.add_argument('--numidx',
                         type=int,
                         default=None,
                         help='number of indices in the Boa output - if not given, infers from the first line')
+    parser.add_argument('--jobs',
+                        '-j',
+                        type=int,
+                        default=1,
+                        help='number of processes to convert with (0 uses every core)')
     parser.add_argument('filename',
                         metavar='boa-jobXX-output.txt',
                         action='store',
@@ -39,6 +65,12 @@ if __name__ == '__main__':
 
     args = parser.parse_args()
 
+    split = None
+    if args.split:
+        split = get_query_config()['queries'].get(args.split, {}).get('csv')
+        if split is None or get_split_vars(split) is None:
+            parser.error(f'The query "{args.split}" does not split its output by variable')
+
     filesize = os.path.getsize(args.filename)
     try:
         from tqdm import tqdm
@@ -46,67 +78,39 @@ if __name__ == '__main__':
     except ImportError:
         pbar = None
 
-    drop = []
-    if args.drop is not None:
-        for x in args.drop:
-            drop.append(x)
+    converter = BoaCsvConverter(args.numidx, args.drop, parse_tests(args.test))
+    jobs = args.jobs if args.jobs > 0 else os.cpu_count()
 
-    test = []
-    ext = {}
-    if args.test is not None:
-        for x in args.test:
-            xs = x.split(',')
-            test.append(int(xs[0]))
-            ext[int(xs[0])] = xs[1]
+    progress = pbar.update if pbar is not None else None
 
     try:
-        with open(args.filename, encoding='utf-8') as f:
-            if args.header is not None:
-                print(args.header)
-
-            s = f.readline()
-            while s is not None and len(s) > 0:
-                if pbar is not None:
-                    pbar.update(len(s))
-
-                if len(s.strip()) == 0:
-                    continue
-
-                s = s[:-1].replace('\\n', '\\\\n').replace('"', '""')
-                parts = []
-
-                cur = 0
-                idx = s.find('[', cur)
-                if idx > -1:
-                    parts.append('"' + s[cur:idx] + '"')
-                    cur = idx + 1
-
-                    idx = s.find('][', cur)
-                    while idx > -1 and idx < len(s) and (args.numidx is None or len(parts) < args.numidx):
-                        if len(parts) in test:
-                            while idx > -1 and idx < len(s) and not re.search(ext[len(parts)], s[cur:idx].lower()):
-                                idx = s.find('][', idx + 2)
-                            if idx == -1 or idx == len(s):
-                                break
-                        parts.append('"' + s[cur:idx] + '"')
-                        cur = idx + 2
-                        idx = s.find('][', cur)
-
-                if args.numidx is None:
-                    args.numidx = len(parts)
-
-                idx = s.find('] = ', cur)
-                if idx > -1:
-                    parts.append('"' + s[cur:idx] + '"')
-                    cur = idx + 1
-
-                idx = s.find(' = ', cur)
-                if idx > -1:
-                    parts.append('"' + s[idx + 3:] + '"')
-
-                parts2 = [x for i, x in enumerate(parts) if i not in drop]
-                print(','.join(parts2))
-                s = f.readline()
+        if split is not None:
+            from boasplit import open_tables, split_blocks
+            with Timer('boa-to-csv', args.filename, bytes=filesize) as timer:
+                rows, skipped = split_blocks(iter_output_blocks(args.filename, progress=progress), open_tables(split))
+                timer.values['rows'] = sum(rows.values())
+                timer.values['skipped'] = skipped
+        else:
+            with Timer('boa-to-csv', args.filename, bytes=filesize) as timer, \
+                    open(sys.stdout.fileno(), 'wb', buffering=WRITE_BUFFER_SIZE, closefd=False) as out:
+                header = args.header
+                schema = None
+                if args.schema:
+                    from boaarrow import CsvSchemaWriter, get_names, parse_types
+                    out = schema = CsvSchemaWriter(out, get_names(args.column, args.header), parse_types(args.type), header is not None)
+                    if header is not None:
+                        schema.write_header(header.encode('utf-8') + b'\n')
+                        header = None
+
+                if jobs > 1:
+                    rows = convert_file_parallel(args.filename, out, converter, jobs, header, progress)
+                else:
+                    rows = convert_blocks(iter_output_blocks(args.filename, progress=progress), out, converter, header)
+                timer.values['rows'] = rows
+
+            # only once the CSV is complete
+            if schema is not None:
+                schema.save(args.schema, converter, rows)
     finally:
         if pbar is not None:
             pbar.close()
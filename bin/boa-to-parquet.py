@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+import argparse
+import os
+from boaarrow import PARQUET_COMPRESSION, ROW_GROUP_SIZE, BoaArrowConverter, ParquetBatchWriter, get_names, parse_types
+from boaio import iter_output_blocks
+from boaparse import convert_blocks, convert_file_parallel, parse_tests
+from utilities import Timer
+
+
+def valid_file(parser, arg):
+    if os.path.exists(arg):
+        return arg
+    parser.error(f'Invalid path: {arg}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('boa-to-parquet.py')
+    parser.add_argument('--test',
+                        '-t',
+                        action='append',
+                        type=str,
+                        help='add a "column,test" pair, where the given column keeps consuming the row until the given regex test matches')
+    parser.add_argument('--drop',
+                        '-d',
+                        action='append',
+                        type=int,
+                        help='columns (0-indexed) to drop when converting')
+    parser.add_argument('--column',
+                        '-c',
+                        action='append',
+                        type=str,
+                        help='the name of the next column (after dropping)')
+    parser.add_argument('--type',
+                        action='append',
+                        type=str,
+                        help='a "column:type" pair giving a column\'s Arrow type, e.g. "count:int64" (columns are strings by default)')
+    parser.add_argument('--header',
+                        type=str,
+                        help='a CSV header row to take the column names from, if no --column is given')
+    parser.add_argument('--numidx',
+                        type=int,
+                        default=None,
+                        help='number of indices in the Boa output - if not given, infers from the first line')
+    parser.add_argument('--compression',
+                        type=str,
+                        default=PARQUET_COMPRESSION,
+                        help=f'the Parquet compression codec (default: {PARQUET_COMPRESSION})')
+    parser.add_argument('--row-group-size',
+                        type=int,
+                        default=ROW_GROUP_SIZE,
+                        help=f'rows per Parquet row group (default: {ROW_GROUP_SIZE})')
+    parser.add_argument('--jobs',
+                        '-j',
+                        type=int,
+                        default=1,
+                        help='number of processes to convert with (0 uses every core)')
+    parser.add_argument('--output',
+                        '-o',
+                        required=True,
+                        type=str,
+                        help='path to write the Parquet file to')
+    parser.add_argument('filename',
+                        metavar='boa-jobXX-output.txt',
+                        action='store',
+                        type=lambda x: valid_file(parser, x),
+                        help='path to the Boa output file to convert')
+
+    args = parser.parse_args()
+
+    try:
+        converter = BoaArrowConverter(args.numidx, args.drop, parse_tests(args.test),
+                                      get_names(args.column, args.header), parse_types(args.type))
+    except (ValueError, KeyError) as e:
+        parser.error(str(e))
+
+    filesize = os.path.getsize(args.filename)
+    try:
+        from tqdm import tqdm
+        pbar = tqdm(total=filesize) if filesize > 250000 else None
+    except ImportError:
+        pbar = None
+
+    jobs = args.jobs if args.jobs > 0 else os.cpu_count()
+
+    progress = pbar.update if pbar is not None else None
+
+    try:
+        with Timer('boa-to-parquet', args.filename, bytes=filesize) as timer, \
+                ParquetBatchWriter(args.output, converter, args.row_group_size, args.compression) as out:
+            if jobs > 1:
+                rows = convert_file_parallel(args.filename, out, converter, jobs, progress=progress)
+            else:
+                rows = convert_blocks(iter_output_blocks(args.filename, progress=progress), out, converter)
+            timer.values['rows'] = rows
+    finally:
+        if pbar is not None:
+            pbar.close()
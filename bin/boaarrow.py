@@ -0,0 +1,300 @@
+# coding: utf-8
+
+# Converts Boa output straight into Arrow record batches and writes them to
+# typed Parquet files, without going through CSV.  Splitting is shared with
+# the CSV converter (see boaparse.py), so both hold the same values.
+#
+# Also infers the column types of converted CSV, for the schema sidecar
+# files that let analyses read CSV with explicit types.
+
+import csv
+import io
+import json
+import os
+from itertools import chain
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pcsv
+import pyarrow.parquet as pq
+from boaparse import BoaParser
+
+ROW_GROUP_SIZE = 1024 * 1024
+PARQUET_COMPRESSION = 'zstd'
+
+
+def parse_types(types):
+    '''Parses 'name:type' arguments into a dict of column name to Arrow type.'''
+    parsed = {}
+    for arg in types or []:
+        name, alias = arg.rsplit(':', 1)
+        parsed[name] = pa.type_for_alias(alias)
+    return parsed
+
+
+def default_names(columns, keep):
+    '''Names the columns of Boa output like the default CSV header: 'var', 'index0', ..., 'value'.'''
+    names = ['var'] + [f'index{i}' for i in range(columns - 2)] + ['value']
+    return [names[i] for i in keep]
+
+
+def get_names(columns=None, header=None):
+    '''Gets the column names given as arguments, or else the names in a CSV header row.'''
+    if columns is None and header is not None:
+        return next(csv.reader([header]))
+    return columns
+
+
+class BoaArrowConverter(BoaParser):
+    '''Converts Boa output to Arrow record batches.  Converted blocks are a
+    tuple of a RecordBatch (or None, if the block had no rows) and the number
+    of rows.
+
+    Args:
+        numidx (Optional[int]): see BoaParser
+        drop (Iterable[int]): see BoaParser
+        tests (Dict[int, ColumnTest]): see BoaParser
+        names (Optional[List[str]]): the names of the columns left after dropping. If None, they are named like default_names().
+        types (Optional[Dict[str, DataType]]): the type of each named column. Columns not listed are strings.
+    '''
+
+    quote = False
+
+    def __init__(self, numidx=None, drop=(), tests=None, names=None, types=None):
+        self.names = list(names) if names else None
+        self.types = types or {}
+        self.schema = None
+        super().__init__(numidx, drop, tests)
+
+    def set_numidx(self, numidx):
+        super().set_numidx(numidx)
+
+        names = self.names
+        if names is None:
+            names = default_names(self.columns, self.keep)
+        elif len(names) != len(self.keep):
+            raise ValueError(f'{len(names)} column names were given, but the output has {len(self.keep)} columns')
+
+        unknown = set(self.types) - set(names)
+        if unknown:
+            raise ValueError(f'Types were given for unknown columns: {", ".join(sorted(unknown))}')
+        self.schema = pa.schema([pa.field(name, self.types.get(name, pa.string())) for name in names])
+
+    def convert(self, data):
+        columns, rows = super().convert(data)
+        if not rows:
+            return (None, 0)
+        return (self._to_batch(columns), rows)
+
+    def _to_batch(self, columns):
+        arrays = []
+        for values, field in zip(columns, self.schema):
+            array = pa.array(values, pa.binary()).cast(pa.string())
+            if field.type != pa.string():
+                # empty values are missing, like read_csv() treats them
+                array = pc.if_else(pc.equal(array, ''), pa.scalar(None, pa.string()), array)
+                try:
+                    array = array.cast(field.type)
+                except pa.ArrowInvalid as e:
+                    raise ValueError(f'Column "{field.name}" is not {field.type}: {e}')
+            arrays.append(array)
+        return pa.RecordBatch.from_arrays(arrays, schema=self.schema)
+
+    def _convert_lines(self, lines):
+        rows = []
+        for line in lines:
+            s = line.decode('utf-8')
+            if len(s.strip()) > 0:
+                parts = [x.encode('utf-8') for x in self.parse_line(s)]
+                width = len(self.keep)
+                if len(parts) > width:
+                    raise ValueError(f'Found {len(parts)} columns instead of {width} in line: {s[:200]}')
+                rows.append(parts + [None] * (width - len(parts)))
+        return ([list(x) for x in zip(*rows)], len(rows))
+
+    def _convert_run(self, data, lines):
+        columns = self._split_run(data, lines)
+        if columns is None:
+            return None
+        return (columns, lines)
+
+    def _join(self, results):
+        results = [x for x in results if x[1]]
+        if not results:
+            return ([], 0)
+        if len(results) == 1:
+            return results[0]
+        columns = [list(chain.from_iterable(x[0][i] for x in results)) for i in range(len(self.keep))]
+        return (columns, sum(x[1] for x in results))
+
+
+class ParquetBatchWriter:
+    '''Writes record batches to a Parquet file, in row groups of about
+    'row_group_size' rows.
+
+    The file is written under a temporary name and only replaces 'path' once
+    it is closed without an error, so a failed conversion never leaves a
+    partial file behind.
+    '''
+
+    def __init__(self, path, converter, row_group_size=ROW_GROUP_SIZE, compression=PARQUET_COMPRESSION):
+        self.path = path
+        self.tmp = f'{path}.{os.getpid()}.tmp'
+        self.converter = converter
+        self.row_group_size = row_group_size
+        self.compression = compression
+        self.writer = None
+        self.pending = []
+        self.pending_rows = 0
+
+    def write(self, batch):
+        if batch is None or batch.num_rows == 0:
+            return
+        self.pending.append(batch)
+        self.pending_rows += batch.num_rows
+        if self.pending_rows >= self.row_group_size:
+            self._flush(False)
+
+    def _flush(self, final):
+        table = pa.Table.from_batches(self.pending)
+        if self.writer is None:
+            self.writer = pq.ParquetWriter(self.tmp, table.schema, compression=self.compression)
+
+        # keep any partial row group for the next write
+        size = table.num_rows if final else table.num_rows - table.num_rows % self.row_group_size
+        if size:
+            self.writer.write_table(table.slice(0, size), row_group_size=self.row_group_size)
+        self.pending = table.slice(size).to_batches()
+        self.pending_rows = table.num_rows - size
+
+    def close(self):
+        if self.pending:
+            self._flush(True)
+        if self.writer is None:
+            schema = self.converter.schema
+            if schema is None:
+                schema = pa.schema([pa.field(name, self.converter.types.get(name, pa.string())) for name in self.converter.names or []])
+            self.writer = pq.ParquetWriter(self.tmp, schema, compression=self.compression)
+        self.writer.close()
+        os.replace(self.tmp, self.path)
+
+    def discard(self):
+        if self.writer is not None:
+            self.writer.close()
+        if os.path.exists(self.tmp):
+            os.unlink(self.tmp)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.discard()
+
+
+def _type_name(type):
+    if pa.types.is_null(type):
+        return None
+    if pa.types.is_integer(type):
+        return str(pa.int64())
+    if pa.types.is_floating(type):
+        return str(pa.float64())
+    if pa.types.is_boolean(type):
+        return str(pa.bool_())
+    return str(pa.string())
+
+
+def _unify(a, b):
+    if a is None or a == b:
+        return b
+    if b is None:
+        return a
+    if {a, b} == {str(pa.int64()), str(pa.float64())}:
+        return str(pa.float64())
+    return str(pa.string())
+
+
+class CsvSchemaWriter:
+    '''Passes converted CSV through to 'out', while inferring the type of
+    each column the same way Arrow's CSV reader would for the whole file.
+
+    Once the conversion is done, save() writes the schema sidecar: the
+    column names, each column's declared or inferred type, and the CSV's
+    size (so readers can tell if the CSV changed since).  If the CSV has
+    rows with different numbers of columns, no sidecar is written, as it
+    could not be read with a fixed schema anyway.
+
+    Args:
+        out: the binary file to write the CSV to
+        names (Optional[List[str]]): the column names. If None, they are named like default_names().
+        types (Optional[Dict[str, DataType]]): declared types, which are not inferred
+        header (bool): whether the CSV starts with a header row
+    '''
+
+    def __init__(self, out, names=None, types=None, header=False):
+        self.out = out
+        self.names = list(names) if names else None
+        self.declared = {name: str(type) for name, type in (types or {}).items()}
+        self.header = header
+        self.size = 0
+        self.inferred = None
+        self.regular = True
+
+    def write(self, data):
+        self.out.write(data)
+        self.size += len(data)
+        if not self.regular or not data:
+            return
+
+        try:
+            table = pcsv.read_csv(io.BytesIO(data),
+                                  read_options=pcsv.ReadOptions(autogenerate_column_names=True, use_threads=False))
+        except pa.ArrowInvalid:
+            self.regular = False
+            return
+
+        types = [_type_name(field.type) for field in table.schema]
+        if self.inferred is None:
+            self.inferred = types
+        elif len(types) != len(self.inferred):
+            self.regular = False
+        else:
+            self.inferred = [_unify(a, b) for a, b in zip(self.inferred, types)]
+
+    def write_header(self, header):
+        self.out.write(header)
+        self.size += len(header)
+
+    def schema(self, converter, rows):
+        '''Gets the sidecar contents, or None if the CSV has no fixed schema.'''
+        if not self.regular:
+            return None
+
+        names = self.names
+        if names is None:
+            if converter.numidx is None:
+                return None
+            names = default_names(converter.columns, converter.keep)
+        inferred = self.inferred or [None] * len(names)
+        if len(inferred) != len(names):
+            return None
+
+        columns = []
+        for name, type in zip(names, inferred):
+            columns.append({'name': name, 'type': self.declared.get(name, type or str(pa.string()))})
+        return {'columns': columns, 'header': self.header, 'rows': rows, 'bytes': self.size}
+
+    def save(self, path, converter, rows):
+        '''Writes the schema sidecar, or removes a stale one if the CSV has no fixed schema.'''
+        schema = self.schema(converter, rows)
+        if schema is None:
+            if os.path.exists(path):
+                os.unlink(path)
+            return
+
+        tmp = f'{path}.{os.getpid()}.tmp'
+        with open(tmp, 'w') as fh:
+            json.dump(schema, fh, indent=2)
+        os.replace(tmp, path)
@@ -0,0 +1,219 @@
+# coding: utf-8
+
+# Reads and writes Boa output files in 'data/txt/', which may be stored
+# plain or compressed.  Compressed files keep their original names and are
+# recognized by their magic bytes, so readers never need to know how an
+# output was stored.
+#
+# Processors read outputs as bytes, in large blocks of whole lines.  Plain
+# files are memory-mapped, so blocks are sliced straight out of the page
+# cache and progress is simply the offset reached in the mapping.
+
+import gzip
+import io
+import mmap
+import os
+import shutil
+
+COMPRESSIONS = ['none', 'gzip', 'zstd']
+COMPRESSION_LEVELS = {'gzip': 6, 'zstd': 10}
+
+GZIP_MAGIC = b'\x1f\x8b'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+COPY_CHUNK_SIZE = 1024 * 1024
+BLOCK_SIZE = 4 * 1024 * 1024
+
+
+def have_zstd():
+    try:
+        import zstandard  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+
+def detect_compression(path):
+    '''Returns how a file is compressed ('gzip' or 'zstd'), or None if it is plain.'''
+    with open(path, 'rb') as fh:
+        magic = fh.read(4)
+    if magic.startswith(GZIP_MAGIC):
+        return 'gzip'
+    if magic == ZSTD_MAGIC:
+        return 'zstd'
+    return None
+
+
+class _CountingReader(io.RawIOBase):
+    '''Reports how many bytes of the underlying file have been read.'''
+
+    def __init__(self, fh, progress):
+        self.fh = fh
+        self.progress = progress
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        n = self.fh.readinto(b)
+        if n:
+            self.progress(n)
+        return n
+
+    def close(self):
+        self.fh.close()
+        super().close()
+
+
+def open_output(path, mode='rt', encoding='utf-8', progress=None):
+    '''Opens a Boa output file for reading, decompressing it if needed.
+
+    Args:
+        path (str): the file to open
+        mode (str): 'rt' for text or 'rb' for bytes. Defaults to 'rt'.
+        encoding (str): the text encoding. Defaults to 'utf-8'.
+        progress (Optional[Callable[[int], None]]): called with the number of bytes read from disk, e.g. a tqdm's update
+
+    Returns:
+        a file object with the uncompressed contents
+    '''
+    compression = detect_compression(path)
+    if compression is None and progress is None:
+        return open(path, mode, encoding=None if 'b' in mode else encoding)
+
+    raw = open(path, 'rb', buffering=0)
+    if progress is not None:
+        raw = _CountingReader(raw, progress)
+
+    if compression == 'gzip':
+        buffered = io.BufferedReader(raw, COPY_CHUNK_SIZE)
+        stream = gzip.GzipFile(fileobj=buffered, mode='rb')
+        # GzipFile does not close a file object it was given
+        stream.myfileobj = buffered
+    elif compression == 'zstd':
+        try:
+            import zstandard
+        except ImportError:
+            raw.close()
+            raise RuntimeError(f'"{path}" is compressed with zstd, install the "zstandard" package to read it')
+        stream = io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(raw, closefd=True), COPY_CHUNK_SIZE)
+    else:
+        stream = io.BufferedReader(raw, COPY_CHUNK_SIZE)
+
+    if 'b' in mode:
+        return stream
+    return io.TextIOWrapper(stream, encoding=encoding)
+
+
+def map_output(path):
+    '''Memory-maps a plain Boa output for reading.
+
+    Returns:
+        Optional[mmap]: the read-only mapping, or None if the file is compressed (or empty) and must be read with open_output()
+    '''
+    if detect_compression(path) is not None or os.path.getsize(path) == 0:
+        return None
+    with open(path, 'rb') as fh:
+        return mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def line_ranges(buf, start, end, size):
+    '''Splits buf[start:end] (e.g., of a mapping) into ranges of whole lines of at least 'size' bytes.'''
+    ranges = []
+    while start < end:
+        stop = end
+        if start + size < end:
+            stop = buf.find(b'\n', start + size, end) + 1 or end
+        ranges.append((start, stop))
+        start = stop
+    return ranges
+
+
+def iter_blocks(fh, block_size=BLOCK_SIZE):
+    '''Reads a binary file in large blocks that each end on a line boundary.'''
+    rest = b''
+    while True:
+        block = fh.read(block_size)
+        if not block:
+            break
+        end = block.rfind(b'\n')
+        if end == -1:
+            rest += block
+            continue
+        yield rest + block[:end + 1]
+        rest = block[end + 1:]
+    if rest:
+        yield rest
+
+
+def iter_output_blocks(path, block_size=BLOCK_SIZE, progress=None):
+    '''Reads a Boa output, plain or compressed, as bytes in large blocks that
+    each end on a line boundary.
+
+    Args:
+        path (str): the file to read
+        block_size (int): roughly how many bytes each block holds
+        progress (Optional[Callable[[int], None]]): called with the number of bytes read from disk, e.g. a tqdm's update
+    '''
+    mm = map_output(path)
+    if mm is None:
+        with open_output(path, 'rb', progress=progress) as fh:
+            yield from iter_blocks(fh, block_size)
+        return
+
+    with mm:
+        for start, end in line_ranges(mm, 0, len(mm), block_size):
+            yield mm[start:end]
+            if progress is not None:
+                progress(end - start)
+
+
+def compress_file(source, dest, compression, level=None):
+    '''Writes a compressed copy of a file, atomically replacing 'dest'.
+
+    Returns:
+        int: the compressed size
+    '''
+    if level is None:
+        level = COMPRESSION_LEVELS.get(compression)
+
+    tmp = f'{dest}.{os.getpid()}.tmp'
+    try:
+        with open(source, 'rb') as src, open(tmp, 'wb') as fh:
+            if compression == 'gzip':
+                with gzip.GzipFile(os.path.basename(dest), 'wb', level, fh, mtime=0) as out:
+                    shutil.copyfileobj(src, out, COPY_CHUNK_SIZE)
+            elif compression == 'zstd':
+                import zstandard
+                cctx = zstandard.ZstdCompressor(level=level, threads=-1, write_content_size=True)
+                cctx.copy_stream(src, fh, size=os.fstat(src.fileno()).st_size,
+                                 read_size=COPY_CHUNK_SIZE, write_size=COPY_CHUNK_SIZE)
+            else:
+                raise ValueError(f'Unknown compression "{compression}"')
+        os.replace(tmp, dest)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+    return os.path.getsize(dest)
+
+
+def output_digest(path, limit=None, chunk_size=COPY_CHUNK_SIZE):
+    '''Computes the size and MD5 of a Boa output's uncompressed contents (or
+    of their first 'limit' bytes).
+
+    Returns:
+        (int, str): the uncompressed size hashed and its MD5 hash
+    '''
+    from hashlib import md5
+
+    hasher = md5()
+    size = 0
+    with open_output(path, 'rb') as fh:
+        while limit is None or size < limit:
+            chunk = fh.read(chunk_size if limit is None else min(chunk_size, limit - size))
+            if not chunk:
+                break
+            hasher.update(chunk)
+            size += len(chunk)
+    return (size, hasher.hexdigest())
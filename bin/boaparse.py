@@ -0,0 +1,514 @@
+# coding: utf-8
+
+# Converts Boa output ('var[index][index] = value' lines) into rows.
+#
+# Output is converted a block of bytes at a time.  Once the number of indices
+# is known, each line's "skeleton" (its brackets and '=' signs) shows whether
+# the line is well-formed, meaning its brackets only ever delimit indices.
+# Runs of well-formed lines are converted with a few whole-block byte
+# operations, and only the remaining lines (brackets or '=' inside values,
+# values failing a column test, blank lines, ...) are parsed one at a time.
+#
+# BoaParser does the splitting, and its subclasses decide what a converted
+# block looks like: BoaCsvConverter here produces CSV, and the Arrow
+# converter in boaarrow.py produces record batches.
+
+import re
+from boaio import BLOCK_SIZE, iter_blocks, line_ranges, map_output
+from collections import deque
+
+try:
+    from re import _parser as sre_parse
+except ImportError:
+    import sre_parse
+
+WRITE_BUFFER_SIZE = 1024 * 1024
+PARALLEL_CHUNK_SIZE = 16 * 1024 * 1024
+
+# every byte except the ones kept in a line's skeleton, and in the skeleton
+# of lines that might still need normalizing
+SKELETON_DELETE = bytes(c for c in range(256) if c not in b'[]=\n')
+RAW_SKELETON_DELETE = bytes(c for c in range(256) if c not in b'[]=\n\r"\\')
+RAW_SKELETON_DELETE_UNQUOTED = bytes(c for c in range(256) if c not in b'[]=\n\r\\')
+NEWLINE_TO_BRACKET = bytes.maketrans(b'\n', b'[')
+
+
+def _suffix_width(regex):
+    '''Returns how many characters a match can span if the regex only ever
+    matches at the end of the string, like '\\.kts?$', or None otherwise.'''
+    try:
+        parsed = sre_parse.parse(regex.pattern, regex.flags)
+    except Exception:
+        return None
+
+    items = list(parsed)
+    if not items or items[-1] not in [(sre_parse.AT, sre_parse.AT_END), (sre_parse.AT, sre_parse.AT_END_STRING)]:
+        return None
+
+    # anything that looks outside the match could see past a shortened column
+    unsafe = {sre_parse.AT, sre_parse.ASSERT, sre_parse.ASSERT_NOT, sre_parse.GROUPREF, sre_parse.GROUPREF_EXISTS}
+
+    def safe(x):
+        if isinstance(x, sre_parse.SubPattern):
+            x = x.data
+        if isinstance(x, (list, tuple)):
+            if len(x) == 2 and x[0] in unsafe:
+                return False
+            return all(safe(y) for y in x)
+        return True
+
+    body = sre_parse.SubPattern(parsed.state, items[:-1])
+    if not safe(body):
+        return None
+    width = body.getwidth()[1]
+    return width if width < sre_parse.MAXREPEAT else None
+
+
+class ColumnTest:
+    '''A compiled column test.  A column keeps consuming indices until its
+    lowercased text contains a match.
+
+    Tests anchored to the end of the column with a bounded match length (the
+    usual file extension tests) only ever need to search the last few
+    characters, so trying every '][' in a long name stays linear.
+    '''
+
+    def __init__(self, regex):
+        self.regex = re.compile(regex)
+        self.width = _suffix_width(self.regex)
+
+    def search(self, s):
+        '''Tests a whole column.'''
+        return self.regex.search(s.lower()) is not None
+
+    def search_line(self, s, low, start, end):
+        '''Tests the column s[start:end], given 'low' (the whole line
+        lowercased, or None if it could not be lowercased piecewise).'''
+        if low is None:
+            return self.regex.search(s[start:end].lower()) is not None
+        if self.width is not None:
+            start = max(start, end - self.width)
+        return self.regex.search(low[start:end]) is not None
+
+
+def lower_line(s):
+    '''Lowercases a line once for all its column tests, or returns None if
+    lowercasing a part of it might not match the same part of the whole.'''
+    low = s.lower()
+    # 'İ' lowercases to two characters, and 'Σ' depends on its neighbours
+    if len(low) != len(s) or 'Σ' in s:
+        return None
+    return low
+
+
+def parse_tests(tests):
+    '''Parses 'column,regex' test arguments into a dict of column to ColumnTest.'''
+    parsed = {}
+    for test in tests or []:
+        column, regex = test.split(',', 1)
+        parsed[int(column)] = ColumnTest(regex)
+    return parsed
+
+
+def normalize(data, quote=True):
+    '''Escapes a block of Boa output, and converts any '\\r' line endings to '\\n' like text mode would.
+
+    Literal '\\n's are always escaped, so every output format holds the same
+    values, but quotes are only doubled for CSV.
+    '''
+    if b'\r' in data:
+        data = data.decode('utf-8').replace('\r\n', '\n').replace('\r', '\n').encode('utf-8')
+    data = data.replace(b'\\n', b'\\\\n')
+    if quote:
+        data = data.replace(b'"', b'""')
+    return data
+
+
+class BoaParser:
+    '''Splits Boa output into rows, producing the same columns as the
+    original line-by-line converter.
+
+    Subclasses decide how converted rows are represented, by implementing
+    _convert_lines(), _convert_run() and _join().
+
+    Args:
+        numidx (Optional[int]): how many columns (the variable name plus all
+            but the last index) to split before the last index. If None, it is
+            inferred from the first line.
+        drop (Iterable[int]): 0-indexed columns to leave out of the output
+        tests (Dict[int, ColumnTest]): columns that keep consuming indices until their test matches
+    '''
+
+    # whether quotes are doubled when normalizing
+    quote = True
+
+    def __init__(self, numidx=None, drop=(), tests=None):
+        self.drop = set(drop or ())
+        self.tests = tests or {}
+        self.numidx = None
+        self.skeleton = None
+        self.raw_skeleton_delete = RAW_SKELETON_DELETE if self.quote else RAW_SKELETON_DELETE_UNQUOTED
+        if numidx is not None:
+            self.set_numidx(numidx)
+
+    def set_numidx(self, numidx):
+        self.numidx = numidx
+        self.columns = numidx + 2
+        self.keep = [i for i in range(self.columns) if i not in self.drop]
+
+        # only the indices split at '][' are tested
+        self.tested = sorted(i for i in self.tests if 0 < i < numidx)
+
+        # lines without any index are rare enough to always parse one at a time
+        if numidx < 1:
+            self.skeleton = None
+        else:
+            self.skeleton = b'[' + b'][' * (numidx - 1) + b']='
+
+    def parse_line(self, s):
+        '''Splits one escaped line (without its newline) into columns.'''
+        parts = []
+
+        cur = 0
+        low = lower_line(s) if self.tests else None
+        idx = s.find('[', cur)
+        if idx > -1:
+            parts.append(s[cur:idx])
+            cur = idx + 1
+
+            idx = s.find('][', cur)
+            while idx > -1 and (self.numidx is None or len(parts) < self.numidx):
+                if len(parts) in self.tests:
+                    test = self.tests[len(parts)]
+                    while idx > -1 and not test.search_line(s, low, cur, idx):
+                        idx = s.find('][', idx + 2)
+                    if idx == -1:
+                        break
+                parts.append(s[cur:idx])
+                cur = idx + 2
+                idx = s.find('][', cur)
+
+        if self.numidx is None:
+            self.set_numidx(len(parts))
+
+        idx = s.find('] = ', cur)
+        if idx > -1:
+            parts.append(s[cur:idx])
+            cur = idx + 1
+
+        idx = s.find(' = ', cur)
+        if idx > -1:
+            parts.append(s[idx + 3:])
+
+        if self.drop:
+            parts = [x for i, x in enumerate(parts) if i not in self.drop]
+        return parts
+
+    def _convert_lines(self, lines):
+        '''Converts escaped lines one at a time, skipping blank lines.'''
+        raise NotImplementedError
+
+    def _convert_run(self, data, lines):
+        '''Converts a run of escaped lines whose skeletons are well-formed.
+
+        The skeletons only show the order of the brackets, so this is where
+        runs are checked for a ']' that is not part of '][' or '] = '.  In the
+        remaining runs '[' only starts an index.  So once each line's '] = '
+        is replaced by '[' and the other ']'s are dropped, every column ends
+        at a single '['.
+
+        Returns None if a ']' or '=' is not part of '][' or '] = '.
+        '''
+        raise NotImplementedError
+
+    def _join(self, results):
+        '''Joins the results of converting consecutive runs of lines.'''
+        raise NotImplementedError
+
+    def _mark_values(self, data, lines):
+        '''Replaces each line's '] = ' with '[', or returns None (see _convert_run()).'''
+        if data.count(b'][') != lines * (self.numidx - 1):
+            return None
+        size = len(data)
+        data = data.replace(b'] = ', b'[')
+        if size - len(data) != 3 * lines:
+            return None
+        return data
+
+    def _split_fields(self, data, lines):
+        '''Splits a well-formed run into a flat list of every row's columns, or None (see _convert_run()).'''
+        data = self._mark_values(data, lines)
+        if data is None:
+            return None
+        return data.translate(NEWLINE_TO_BRACKET, b']').split(b'[')
+
+    def _test_failures(self, fields, lines):
+        '''Finds the rows of a split run with a tested column that fails its
+        test.  Those need parsing one at a time, to keep consuming indices.'''
+        failures = set()
+        for i in self.tested:
+            test = self.tests[i]
+            for row, value in enumerate(fields[i:lines * self.columns:self.columns]):
+                if not test.search(value.decode('utf-8')):
+                    failures.add(row)
+        return failures
+
+    def _split_run(self, data, lines):
+        '''Splits a well-formed run into one list of values per kept column, or
+        None (see _convert_run(), and also if any row fails a column test).'''
+        fields = self._split_fields(data, lines)
+        if fields is None or (self.tested and self._test_failures(fields, lines)):
+            return None
+        return [fields[i:lines * self.columns:self.columns] for i in self.keep]
+
+    def convert(self, data):
+        '''Converts a block of complete lines of Boa output.
+
+        Returns:
+            a tuple of the converted rows and the number of rows
+        '''
+        if not data:
+            return self._join([])
+        if data[-1:] != b'\n':
+            data += b'\n'
+
+        if self.numidx is None:
+            first, data = self.normalize(data).split(b'\n', 1)
+            return self._join([self._convert_lines([first]), self._convert_normalized(data)])
+
+        if self.skeleton is not None:
+            # most blocks have nothing to escape or normalize, which their
+            # skeletons show without scanning for it separately
+            skeletons = data.translate(None, self.raw_skeleton_delete)
+            lines = len(skeletons) // (len(self.skeleton) + 1)
+            if skeletons == (self.skeleton + b'\n') * lines:
+                result = self._convert_run(data, lines)
+                if result is not None:
+                    return result
+
+        return self._convert_normalized(self.normalize(data))
+
+    def normalize(self, data):
+        return normalize(data, self.quote)
+
+    def _convert_normalized(self, data):
+        if not data:
+            return self._join([])
+        if self.skeleton is None:
+            return self._convert_lines(data[:-1].split(b'\n'))
+
+        skeletons = data.translate(None, SKELETON_DELETE)
+        lines = len(skeletons) // (len(self.skeleton) + 1)
+        if skeletons == (self.skeleton + b'\n') * lines:
+            result = self._convert_run(data, lines)
+            if result is not None:
+                return result
+
+        # convert the runs of well-formed lines in bulk, and the rest one at a time
+        output = []
+        lines = data[:-1].split(b'\n')
+        good = [x == self.skeleton for x in skeletons[:-1].split(b'\n')]
+        if self.tested:
+            self._mark_test_failures(lines, good)
+        start = 0
+        while start < len(lines):
+            end = start + 1
+            while end < len(lines) and good[end] == good[start]:
+                end += 1
+
+            run = lines[start:end]
+            result = None
+            if good[start]:
+                result = self._convert_run(b'\n'.join(run) + b'\n', len(run))
+            if result is None:
+                result = self._convert_lines(run)
+            output.append(result)
+            start = end
+        return self._join(output)
+
+    def _mark_test_failures(self, lines, good):
+        candidates = [i for i, x in enumerate(good) if x]
+        fields = self._split_fields(b'\n'.join(lines[i] for i in candidates) + b'\n', len(candidates))
+        if fields is None:
+            # the runs will be rejected (and parsed one at a time) anyway
+            return
+        for row in self._test_failures(fields, len(candidates)):
+            good[candidates[row]] = False
+
+
+class BoaCsvConverter(BoaParser):
+    '''Converts Boa output to CSV, producing the same rows as the original
+    line-by-line converter.  Converted blocks are a tuple of the CSV bytes
+    (one line per row, each ending in a newline) and the number of rows.'''
+
+    def format_line(self, s):
+        return ','.join('"' + x + '"' for x in self.parse_line(s))
+
+    def _convert_lines(self, lines):
+        rows = []
+        for line in lines:
+            s = line.decode('utf-8')
+            if len(s.strip()) > 0:
+                rows.append(self.format_line(s).encode('utf-8') + b'\n')
+        return (b''.join(rows), len(rows))
+
+    def _convert_run(self, data, lines):
+        if not self.drop and not self.tested:
+            data = self._mark_values(data, lines)
+            if data is None:
+                return None
+            data = data.translate(None, b']').replace(b'[', b'","').replace(b'\n', b'"\n"')
+            return (b'"' + data[:-1], lines)
+
+        columns = self._split_run(data, lines)
+        if columns is None:
+            return None
+        if not columns:
+            return (b'\n' * lines, lines)
+        return (b'"' + b'"\n"'.join(map(b'","'.join, zip(*columns))) + b'"\n', lines)
+
+    def _join(self, results):
+        return (b''.join(x[0] for x in results), sum(x[1] for x in results))
+
+
+def convert_blocks(blocks, out, converter, header=None):
+    '''Converts blocks of whole lines of Boa output (e.g., from
+    boaio.iter_output_blocks()), writing each converted block to 'out' (a
+    binary file for CSV, or a writer with a matching write() for other
+    converters).
+
+    Returns:
+        int: the number of rows written (not counting the header)
+    '''
+    if header is not None:
+        out.write(header.encode('utf-8') + b'\n')
+
+    rows = 0
+    for block in blocks:
+        converted, n = converter.convert(block)
+        if n:
+            out.write(converted)
+        rows += n
+    return rows
+
+
+def convert_file(fh, out, converter, header=None, block_size=BLOCK_SIZE):
+    '''Converts a Boa output file opened in binary mode, like convert_blocks().'''
+    return convert_blocks(iter_blocks(fh, block_size), out, converter, header)
+
+
+# finds the first line not starting with a given variable's name, per variable
+_var_run_ends = {}
+
+
+def split_vars(data):
+    '''Splits a block of whole lines of Boa output into runs of consecutive
+    lines with the same output variable (the name before the first '[').
+
+    Boa writes each variable's lines together, so a block is usually one or
+    a few runs, and the end of a run is found with a single regex search
+    instead of looking at every line.
+
+    Yields:
+        (Optional[str], bytes): the variable, or None for lines without one (e.g., blank lines), and its lines
+    '''
+    pos = 0
+    size = len(data)
+    while pos < size:
+        eol = data.find(b'\n', pos) + 1 or size
+        idx = data.find(b'[', pos, eol)
+        if idx == -1:
+            yield (None, data[pos:eol])
+            pos = eol
+            continue
+
+        var = data[pos:idx]
+        run_end = _var_run_ends.get(var)
+        if run_end is None:
+            run_end = _var_run_ends[var] = re.compile(b'^(?!' + re.escape(var + b'[') + b')', re.M)
+        m = run_end.search(data, eol)
+        end = m.start() if m is not None else size
+        yield (var.decode('utf-8', 'replace'), data[pos:end])
+        pos = end
+
+
+# the converter used by each worker process of convert_file_parallel()
+_worker_converter = None
+
+
+def _init_worker(converter):
+    global _worker_converter
+    _worker_converter = converter
+
+
+def _convert_range(filename, start, end):
+    with map_output(filename) as mm:
+        data = mm[start:end]
+    return _worker_converter.convert(data)
+
+
+def _convert_block(data):
+    return _worker_converter.convert(data)
+
+
+def _in_order(tasks, window):
+    pending = deque()
+    for task in tasks:
+        pending.append(task)
+        if len(pending) >= window:
+            future, size = pending.popleft()
+            yield future.result(), size
+    while pending:
+        future, size = pending.popleft()
+        yield future.result(), size
+
+
+def convert_file_parallel(filename, out, converter, jobs, header=None, progress=None, chunk_size=PARALLEL_CHUNK_SIZE):
+    '''Converts a Boa output file using a pool of worker processes, writing
+    to 'out' in the same order as convert_file().
+
+    Plain files are split into byte ranges at line boundaries that each
+    worker maps for itself.  Compressed files can only be read in order, so
+    they are read here and handed to the workers a block at a time.
+
+    If the number of indices must be inferred, the first line is converted
+    here before any work is handed out, so every worker splits the same way.
+
+    Returns:
+        int: the number of rows written (not counting the header)
+    '''
+    from boaio import open_output
+    from concurrent.futures import ProcessPoolExecutor
+
+    if header is not None:
+        out.write(header.encode('utf-8') + b'\n')
+
+    mm = map_output(filename)
+    rows = 0
+    with mm if mm is not None else open_output(filename, 'rb', progress=progress) as fh:
+        while converter.numidx is None:
+            line = fh.readline()
+            if not line:
+                return rows
+            converted, n = converter.convert(line)
+            if n:
+                out.write(converted)
+            rows += n
+
+        with ProcessPoolExecutor(jobs, initializer=_init_worker, initargs=(converter,)) as pool:
+            if mm is None:
+                tasks = ((pool.submit(_convert_block, block), 0) for block in iter_blocks(fh, chunk_size))
+            else:
+                start = mm.tell()
+                if progress is not None:
+                    progress(start)
+                ranges = line_ranges(mm, start, len(mm), chunk_size)
+                tasks = ((pool.submit(_convert_range, filename, s, e), e - s) for (s, e) in ranges)
+
+            for (converted, n), size in _in_order(tasks, 2 * jobs):
+                if n:
+                    out.write(converted)
+                rows += n
+                if progress is not None and size:
+                    progress(size)
+    return rows
@@ -0,0 +1,124 @@
+# coding: utf-8
+
+# Splits a Boa output with several output variables into a separate table
+# per variable, in a single pass over the output.  Each variable's lines go
+# through their own converter, so every table can have its own tests,
+# dropped columns, header and format, as configured in the query's
+# "csv": {"vars": {...}} in study-config.json.
+#
+# Tables are written under temporary names and only replace the previous
+# ones once the whole output was converted.
+
+import os
+from boaparse import WRITE_BUFFER_SIZE, BoaCsvConverter, parse_tests, split_vars
+from utilities import CSV_ROOT, get_split_vars
+
+
+class CsvTable:
+    '''Converts one variable's lines to a CSV file, with its schema sidecar.'''
+
+    def __init__(self, info, root=CSV_ROOT):
+        from boaarrow import CsvSchemaWriter, get_names, parse_types
+
+        self.path = root + info['output']
+        self.sidecar = root + info['output'][:-4] + '.schema.json'
+        self.tmp = f'{self.path}.{os.getpid()}.tmp'
+        self.converter = BoaCsvConverter(info.get('index'), info.get('drop'), parse_tests(info.get('test')))
+        self.rows = 0
+
+        header = info.get('header')
+        types = parse_types(f'{column}:{type}' for column, type in info.get('types', {}).items())
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        self.fh = open(self.tmp, 'wb', buffering=WRITE_BUFFER_SIZE)
+        self.out = CsvSchemaWriter(self.fh, get_names(info.get('columns'), header), types, header is not None)
+        if header is not None:
+            self.out.write_header(header.encode('utf-8') + b'\n')
+
+    def write(self, data):
+        converted, n = self.converter.convert(data)
+        if n:
+            self.out.write(converted)
+        self.rows += n
+
+    def close(self):
+        self.fh.close()
+        os.replace(self.tmp, self.path)
+        self.out.save(self.sidecar, self.converter, self.rows)
+
+    def discard(self):
+        self.fh.close()
+        if os.path.exists(self.tmp):
+            os.unlink(self.tmp)
+
+
+class ParquetTable:
+    '''Converts one variable's lines straight to a typed Parquet file.'''
+
+    def __init__(self, info, root=CSV_ROOT):
+        from boaarrow import BoaArrowConverter, ParquetBatchWriter, get_names, parse_types
+
+        self.path = root + info['output'][:-4] + '.parquet'
+        types = parse_types(f'{column}:{type}' for column, type in info.get('types', {}).items())
+        self.converter = BoaArrowConverter(info.get('index'), info.get('drop'), parse_tests(info.get('test')),
+                                           get_names(info.get('columns'), info.get('header')), types)
+        self.rows = 0
+
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        self.out = ParquetBatchWriter(self.path, self.converter)
+
+    def write(self, data):
+        batch, n = self.converter.convert(data)
+        self.out.write(batch)
+        self.rows += n
+
+    def close(self):
+        self.out.close()
+
+    def discard(self):
+        self.out.discard()
+
+
+def open_tables(csv_info, root=CSV_ROOT):
+    '''Opens a table for each variable a 'csv' config splits its output into.
+
+    Returns:
+        Dict[str, Union[CsvTable, ParquetTable]]: the table of each variable
+    '''
+    tables = {}
+    try:
+        for var, info in get_split_vars(csv_info).items():
+            table = ParquetTable if info.get('format', 'csv') == 'parquet' else CsvTable
+            tables[var] = table(info, root)
+    except BaseException:
+        for table in tables.values():
+            table.discard()
+        raise
+    return tables
+
+
+def split_blocks(blocks, tables):
+    '''Sends the lines of each variable in blocks of whole lines of Boa
+    output (e.g., from boaio.iter_output_blocks()) to that variable's table.
+    Every table is closed once all blocks were split, or discarded if there
+    was an error.
+
+    Returns:
+        (Dict[str, int], int): the rows written per variable, and the number of lines of variables without a table
+    '''
+    skipped = 0
+    try:
+        for block in blocks:
+            for var, data in split_vars(block):
+                table = tables.get(var)
+                if table is not None:
+                    table.write(data)
+                elif data.strip():
+                    skipped += data.count(b'\n') + (not data.endswith(b'\n'))
+    except BaseException:
+        for table in tables.values():
+            table.discard()
+        raise
+
+    for table in tables.values():
+        table.close()
+    return ({var: table.rows for var, table in tables.items()}, skipped)
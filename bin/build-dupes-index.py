@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+import argparse
+import os
+import tempfile
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from boaarrow import PARQUET_COMPRESSION, ROW_GROUP_SIZE, BoaArrowConverter
+from boaio import detect_compression, iter_output_blocks
+from utilities import Timer
+
+MEMORY_LIMIT = 1024
+
+INDEX_SCHEMA = pa.schema([
+    pa.field('hash', pa.int64()),
+    pa.field('project', pa.string()),
+    pa.field('file', pa.string()),
+    pa.field('ts', pa.int64()),
+    pa.field('size', pa.int64()),
+])
+
+
+def valid_file(parser, arg):
+    if os.path.exists(arg):
+        return arg
+    parser.error(f'Invalid path: {arg}')
+
+
+def positive_int(parser, arg):
+    try:
+        value = int(arg)
+    except ValueError:
+        value = 0
+    if value > 0:
+        return value
+    parser.error(f'Must be a positive number: {arg}')
+
+
+def to_rows(batch):
+    '''Turns a converted batch of 'o[hash][project] = file' (or
+    'o[hash][project][ts] = file') lines into (hash, project, file, ts) rows.'''
+    ts = batch.column('index2').cast(pa.int64()) if 'index2' in batch.schema.names else pa.nulls(batch.num_rows, pa.int64())
+    return pa.Table.from_arrays([batch.column('index0').cast(pa.int64()), batch.column('index1'), batch.column('value'), ts],
+                                schema=pa.schema(list(INDEX_SCHEMA)[:-1]))
+
+
+class HashPartitioner:
+    '''Collects rows, and hands them back grouped into partitions that each
+    hold every row of some hashes, in the order they were added.
+
+    Rows are kept in memory until they take more than 'memory' bytes.  From
+    then on, each spill splits them by hash into one file per partition, and
+    the partitions are read back one at a time, so only about one partition
+    is ever in memory.
+    '''
+
+    def __init__(self, memory, partitions, tmpdir):
+        self.memory = memory
+        self.partitions = partitions
+        self.tmpdir = tmpdir
+        self.pending = []
+        self.pending_bytes = 0
+        self.spills = 0
+
+    def add(self, table):
+        self.pending.append(table)
+        self.pending_bytes += table.nbytes
+        if self.pending_bytes > self.memory:
+            self._spill()
+
+    def _path(self, partition, spill):
+        return os.path.join(self.tmpdir, f'{partition}.{spill}.arrow')
+
+    def _spill(self):
+        table = pa.concat_tables(self.pending).combine_chunks()
+        self.pending = []
+        self.pending_bytes = 0
+
+        # the partitions are a power of two, so masking the low bits also works for negative hashes
+        part = np.bitwise_and(table.column('hash').to_numpy(), self.partitions - 1)
+        table = table.take(np.argsort(part, kind='stable'))
+        offsets = np.concatenate([[0], np.cumsum(np.bincount(part, minlength=self.partitions))])
+        # files are only open while they are written, so there can be more partitions than open files
+        for i in range(self.partitions):
+            if offsets[i + 1] > offsets[i]:
+                with pa.ipc.new_stream(self._path(i, self.spills), table.schema) as writer:
+                    writer.write_table(table.slice(offsets[i], offsets[i + 1] - offsets[i]))
+        self.spills += 1
+
+    def __iter__(self):
+        if self.spills == 0:
+            if self.pending:
+                yield pa.concat_tables(self.pending)
+            self.pending = []
+            return
+
+        if self.pending:
+            self._spill()
+        for i in range(self.partitions):
+            tables = []
+            for spill in range(self.spills):
+                path = self._path(i, spill)
+                if os.path.exists(path):
+                    with pa.memory_map(path) as source:
+                        tables.append(pa.ipc.open_stream(source).read_all())
+                    os.unlink(path)
+            if tables:
+                yield pa.concat_tables(tables)
+
+
+def find_dupes(table):
+    '''Keeps the rows whose hash appears more than once, with the size of its
+    group.  Each group keeps the order of the Boa output, so like gendupes.py,
+    its first row is the copy that is kept.'''
+    # joins do not keep the order of rows
+    table = table.append_column('seq', pa.array(np.arange(table.num_rows, dtype=np.int64)))
+    counts = table.group_by('hash').aggregate([('hash', 'count')])
+    counts = counts.filter(pc.greater(counts.column('hash_count'), 1))
+    table = table.join(counts, 'hash', join_type='inner')
+    table = table.sort_by([('hash', 'ascending'), ('seq', 'ascending')])
+    return table.select(['hash', 'project', 'file', 'ts', 'hash_count']).rename_columns(INDEX_SCHEMA.names)
+
+
+def build_index(filename, output, memory, progress=None, ts=False, compression=PARQUET_COMPRESSION):
+    '''Builds the Parquet index of duplicated hashes in a 'hashes.boa' output.
+
+    Returns:
+        (int, int): the number of lines read, and the number of rows in the index
+    '''
+    assert memory > 0, 'the memory cap must be positive'
+
+    # partitions should fit in memory, even for compressed input, which is several times its size
+    estimate = os.path.getsize(filename) * (5 if detect_compression(filename) else 1)
+    partitions = 2
+    while estimate / partitions > memory / 2:
+        partitions *= 2
+
+    # the number of indices is never inferred, as file names can contain '][' too
+    converter = BoaArrowConverter(3 if ts else 2)
+    lines = 0
+    rows = 0
+    tmp = f'{output}.{os.getpid()}.tmp'
+    writer = pq.ParquetWriter(tmp, INDEX_SCHEMA, compression=compression)
+    try:
+        with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(output))) as tmpdir:
+            partitioner = HashPartitioner(memory, partitions, tmpdir)
+            for block in iter_output_blocks(filename, progress=progress):
+                batch, n = converter.convert(block)
+                if n:
+                    partitioner.add(to_rows(batch))
+                lines += n
+
+            for table in partitioner:
+                table = find_dupes(table)
+                if table.num_rows:
+                    writer.write_table(table.cast(INDEX_SCHEMA), row_group_size=ROW_GROUP_SIZE)
+                rows += table.num_rows
+        writer.close()
+    except BaseException:
+        writer.close()
+        os.unlink(tmp)
+        raise
+    os.replace(tmp, output)
+    return lines, rows
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('build-dupes-index.py')
+    parser.add_argument('--memory',
+                        '-m',
+                        type=lambda x: positive_int(parser, x),
+                        default=MEMORY_LIMIT,
+                        help=f'roughly how many MB of rows to hold in memory before spilling to disk (default: {MEMORY_LIMIT})')
+    parser.add_argument('--ts',
+                        action='store_true',
+                        help='if the output also has the file timestamps (\'o[hash][project][ts] = file\')')
+    parser.add_argument('--output',
+                        '-o',
+                        required=True,
+                        type=str,
+                        help='path to write the Parquet index to')
+    parser.add_argument('filename',
+                        metavar='hashes.txt',
+                        action='store',
+                        type=lambda x: valid_file(parser, x),
+                        help='path to the output of a hashes.boa query')
+
+    args = parser.parse_args()
+
+    filesize = os.path.getsize(args.filename)
+    try:
+        from tqdm import tqdm
+        pbar = tqdm(total=filesize) if filesize > 250000 else None
+    except ImportError:
+        pbar = None
+
+    try:
+        with Timer('dupes-index', args.filename, bytes=filesize) as timer:
+            lines, rows = build_index(args.filename, args.output, args.memory * 1024 * 1024,
+                                      pbar.update if pbar is not None else None, args.ts)
+            timer.values['lines'] = lines
+            timer.values['rows'] = rows
+    finally:
+        if pbar is not None:
+            pbar.close()
@@ -1,13 +1,37 @@
 #!/usr/bin/env python3
 # coding: utf-8
 
-from utilities import get_query_config, build_replacements, TXT_ROOT, CSV_ROOT, PQ_ROOT, ANALYSIS_ROOT
+from utilities import get_csv_outputs, get_enabled_analyses, get_query_config, get_query_inputs, get_split_vars, TXT_ROOT, CSV_ROOT, PQ_ROOT, ANALYSIS_ROOT
 
 
 def escape(s):
     return s.replace(' ', '\\ ')
 
 
+def converter_options(csv_info):
+    string = ''
+    if not isinstance(csv_info, str):
+        if 'test' in csv_info:
+            for test in csv_info['test']:
+                string += ' -t "' + test.replace('$', '$$') + '"'
+        if 'drop' in csv_info:
+            for d in csv_info['drop']:
+                string += f' -d {int(d)}'
+        if 'header' in csv_info:
+            string += f' --header "{csv_info["header"]}"'
+        if 'numidx' in csv_info:
+            string += f' --numidx {int(csv_info["index"])}'
+        for column in csv_info.get('columns', []):
+            string += f' -c "{column}"'
+        for column, type in csv_info.get('types', {}).items():
+            string += f' --type "{column}:{type}"'
+    return string
+
+
+def is_parquet(csv_info):
+    return not isinstance(csv_info, str) and csv_info.get('format', 'csv') == 'parquet'
+
+
 def processCSV(csv_info, target, clean_target, cacheclean=None):
     if isinstance(csv_info, str):
         csv_filename = csv_info
@@ -19,6 +43,7 @@ def processCSV(csv_info, target, clean_target, cacheclean=None):
     filename = escape(csv_filename[:-4])
     print('')
     print(f'{clean_target} += {csv_output}')
+    print(f'{clean_target} += {CSV_ROOT}{filename}.schema.json')
     print(f'{clean_target} += {PQ_ROOT}$**/{filename}.parquet')
     print(f'{clean_target} += {PQ_ROOT}$**/{filename}-deduped.parquet')
     if cacheclean:
@@ -26,29 +51,69 @@ def processCSV(csv_info, target, clean_target, cacheclean=None):
             print(f'{clean_target} += {PQ_ROOT}$**/{clean}')
     print(f'{csv_output}: {target}')
     print('\t@$(MKDIR) "$(dir $@)"')
-    string = '\t$(BOATOCSV)'
-    if not isinstance(csv_info, str):
-        if 'test' in csv_info:
-            for test in csv_info['test']:
-                string += ' -t "' + test.replace('$', '$$') + '"'
-        if 'drop' in csv_info:
-            for d in csv_info['drop']:
-                string += f' -d {int(d)}'
-        if 'header' in csv_info:
-            string += f' --header "{csv_info["header"]}"'
-        if 'numidx' in csv_info:
-            string += f' --numidx {int(csv_info["index"])}'
-    string += ' "$<" > "$@"'
-    print(string)
-    print(f'\t@$(RM) {PQ_ROOT}$**/{filename}.parquet')
-    print(f'\t@$(RM) {PQ_ROOT}$**/{filename}-deduped.parquet')
-    if cacheclean:
-        for clean in cacheclean:
-            print(f'\t@$(RM) {PQ_ROOT}$**/{clean}')
+    print('\t$(BOATOCSV)' + converter_options(csv_info) + f' --schema "{CSV_ROOT}{filename}.schema.json" "$<" > "$@"')
 
     return csv_output
 
 
+def processParquet(csv_info, target, clean_target):
+    filename = escape(csv_info['output'][:-4])
+    pq_output = CSV_ROOT + filename + '.parquet'
+
+    string = '\t$(BOATOPARQUET)' + converter_options(csv_info) + ' -o "$@" "$<"'
+
+    print('')
+    print(f'{clean_target} += {pq_output}')
+    print(f'{pq_output}: {target}')
+    print('\t@$(MKDIR) "$(dir $@)"')
+    print(string)
+
+    return pq_output
+
+
+def processSplit(csv_info, target, query, clean_target, converted):
+    '''Makes one rule that converts an output split by variable into all of
+    its tables at once.
+
+    Returns:
+        (List[str], List[str]): the CSV tables, and the Parquet tables
+    '''
+    tables = get_split_vars(csv_info).values()
+    outputs = get_csv_outputs(csv_info)
+    directories = sorted(set(x[:x.rfind('/') + 1] for x in outputs))
+    outputs = [escape(x) for x in outputs]
+
+    print('')
+    for info, output in zip(tables, outputs):
+        filename = escape(info['output'][:-4])
+        print(f'{clean_target} += {output}')
+        if not is_parquet(info):
+            print(f'{clean_target} += {CSV_ROOT}{filename}.schema.json')
+        converted[CSV_ROOT + escape(info['output'])] = output
+    print(' '.join(outputs) + f' &: {target}')
+    print('\t@$(MKDIR) ' + ' '.join(f'"{x}"' for x in directories))
+    print(f'\t$(BOATOCSV) --split "{query}" "$<"')
+
+    csv_outputs = [x for info, x in zip(tables, outputs) if not is_parquet(info)]
+    parquet_outputs = [x for info, x in zip(tables, outputs) if is_parquet(info)]
+    return csv_outputs, parquet_outputs
+
+
+def processOutput(csv_info, target, clean_target, converted, cacheclean=None):
+    '''Makes the rules to convert a Boa output.  Outputs converted straight
+    to Parquet still get a CSV rule, but it is only built on request.
+
+    Returns:
+        (str, str): the CSV, and what to build by default
+    '''
+    csv_output = processCSV(csv_info, target, clean_target, cacheclean)
+    output = csv_output
+    if is_parquet(csv_info):
+        output = processParquet(csv_info, target, clean_target)
+    converted[csv_output] = output
+    return csv_output, output
+
+
 if __name__ == '__main__':
     configuration = get_query_config()
 
@@ -57,11 +122,14 @@ if __name__ == '__main__':
 
     txt = []
     csv = []
-
-    for target in configuration['queries']:
-        query_info = configuration['queries'][target]
-        substitution_files = [escape(x) for (_, x) in build_replacements(configuration.get('substitutions', []), query_info.get('substitutions', []), only_files=True)]
-        target = TXT_ROOT + escape(target)
+    parquet = []
+    csv_export = []
+    converted = {}
+
+    for query in configuration['queries']:
+        query_info = configuration['queries'][query]
+        inputs = [escape(x) for x in get_query_inputs(configuration, query)]
+        target = TXT_ROOT + escape(query)
         txt.append(target)
 
         clean_target = f'clean-{target}'
@@ -70,12 +138,20 @@ if __name__ == '__main__':
         print(f'# Make targets for {target}')
         print(f'{clean_target} := {target}')
 
-        if 'csv' in query_info:
-            csv.append(processCSV(query_info['csv'], target, clean_target))
+        if 'csv' in query_info and get_split_vars(query_info['csv']) is not None:
+            csv_outputs, parquet_outputs = processSplit(query_info['csv'], target, query, clean_target, converted)
+            csv += csv_outputs
+            parquet += parquet_outputs
+            csv_export += csv_outputs
+        elif 'csv' in query_info:
+            csv_output, output = processOutput(query_info['csv'], target, clean_target, converted)
+            csv_export.append(csv_output)
+            (parquet if is_parquet(query_info['csv']) else csv).append(output)
 
         if 'processors' in query_info:
             procTarget = target
-            if 'csv' in query_info:
+            # outputs split by variable have no single CSV, so their processors read the Boa output
+            if 'csv' in query_info and get_split_vars(query_info['csv']) is None:
                 if isinstance(query_info['csv'], str):
                     csv_filename = query_info['csv']
                 else:
@@ -85,21 +161,30 @@ if __name__ == '__main__':
             for postproc in query_info['processors']:
                 processor = query_info['processors'][postproc]
                 proc_output = escape(processor['output'])
-                txt.append(proc_output)
+                proc_args = ''.join(' "' + arg.replace('$', '$$') + '"' for arg in processor.get('args', []))
 
                 print('')
                 print(f'{clean_target} += {proc_output}')
+                if proc_output.endswith('.parquet'):
+                    for clean in processor.get('cacheclean', []):
+                        print(f'{clean_target} += {PQ_ROOT}$**/{clean}')
                 print(f'{proc_output}: {procTarget}')
                 print(f'\t@$(MKDIR) "$(dir {proc_output})"')
-                print(f'\t$(PYTHON) bin/{postproc} "{procTarget}" > "$@"')
+                if proc_output.endswith('.parquet'):
+                    # processors making Parquet files (e.g., build-dupes-index.py) write them themselves
+                    parquet.append(proc_output)
+                    print(f'\t$(PYTHON) bin/{postproc}{proc_args} -o "$@" "{procTarget}"')
+                else:
+                    txt.append(proc_output)
+                    print(f'\t$(PYTHON) bin/{postproc}{proc_args} "{procTarget}" > "$@"')
 
                 if 'csv' in processor:
-                    csv.append(processCSV(processor['csv'], proc_output, clean_target, processor['cacheclean']))
+                    csv_output, output = processOutput(processor['csv'], proc_output, clean_target, converted, processor['cacheclean'])
+                    csv_export.append(csv_output)
+                    (parquet if is_parquet(processor['csv']) else csv).append(output)
 
         print('')
-        string = escape(f'boa/{query_info["query"]}')
-        string += ' ' + ' '.join(substitution_files)
-        print(f'{target}: {string.strip()}')
+        print(f'{target}: ' + ' '.join(inputs))
         print('\t$(DOWNLOAD) "$@"')
         print('')
 
@@ -108,33 +193,41 @@ if __name__ == '__main__':
         print(f'\t$(RM) $({clean_target}) ')
 
     print('')
-    print('.PHONY: txt csv')
+    print('.PHONY: txt csv parquet csv-export')
     print('txt: ' + ' '.join(txt))
     print('csv: ' + ' '.join(csv))
+    print('parquet: ' + ' '.join(parquet))
+    print('csv-export: ' + ' '.join(csv_export))
 
     if 'analyses' in configuration:
         analyses = []
+        analysis_inputs = []
+        enabled = get_enabled_analyses(configuration)
 
         for script in configuration['analyses']:
-            script = escape(script)
-            target = script.split('.')[0]
-            if 'disabled' not in configuration['analyses'][script] or not configuration['analyses'][script]['disabled']:
-                analyses.append(target)
+            target = escape(script).split('.')[0]
 
             inputs = configuration['analyses'][script]['input']
             inputs = [CSV_ROOT + escape(x) for x in inputs]
+            inputs = [converted.get(x, x) for x in inputs]
+            if script in enabled:
+                analyses.append(target)
+                analysis_inputs += [x for x in inputs if x not in analysis_inputs]
 
             print('')
-            print(f'{target}-reproduce: {ANALYSIS_ROOT}{script}')
-            print(f'\t$(PYTHON) {ANALYSIS_ROOT}{script}')
+            print(f'{target}-reproduce: {ANALYSIS_ROOT}{escape(script)}')
+            print(f'\t$(PYTHON) {ANALYSIS_ROOT}{escape(script)}')
             print(f'{target}: ' + ' '.join(inputs) + f' {target}-reproduce')
 
         if len(analyses) > 0:
+            # all enabled analyses run in one process, so inputs they share are only loaded once
             reproductions = [f'{x}-reproduce' for x in analyses]
             print('')
             print('.PHONY: analysis reproduce ' + ' '.join(analyses) + ' ' + ' '.join(reproductions))
-            print('analysis:: ' + ' '.join(analyses))
-            print('reproduce:: ' + ' '.join(reproductions))
+            print('analysis:: ' + ' '.join(analysis_inputs))
+            print('\t$(PYTHON) bin/run-analyses.py')
+            print('reproduce::')
+            print('\t$(PYTHON) bin/run-analyses.py')
     else:
         print('analysis:: data')
         print('reproduce::')
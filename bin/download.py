@@ -2,38 +2,88 @@
 # coding: utf-8
 
 from boaapi.status import CompilerStatus, ExecutionStatus
-from hashlib import md5
+from boaio import detect_compression, output_digest
+import json
 from pathlib import Path
+import time
+from polling import record_phases, wait_for_jobs
+from store import load_entry, put_output, record_job, restore_output
 from utilities import *
 
 
-def run_query(config, target):
-    logger.info('Running query again...')
-
+def submit_query(config, target):
     client = get_client()
     query, hash = prepare_query(config, target)
-    job = client.query(query, get_dataset(config, target))
-
+    with Timer('submit', target):
+        job = client.query(query, get_dataset(config, target))
     logger.debug(f'Job {job.id} is running...')
-    with Timer():
-        job.wait()
-    logger.debug(f'Job {job.id} is complete.')
+    return (job, hash)
+
 
+def check_job(job):
     if job.compiler_status is CompilerStatus.ERROR:
         logger.error(f'Job {job.id} had a compilation error.')
         for error in job.get_compiler_errors():
             logger.error(error)
-        exit(21)
+        return 21
     if job.exec_status is ExecutionStatus.ERROR:
         logger.error(f'Job {job.id} had an execution error.')
         logger.error(f'See url: {job.get_url()}')
-        exit(22)
+        return 22
+    return 0
 
-    update_query_data(target, job.id, hash)
+
+def finish_query(target, job_id, hash):
+    update_query_data(target, job_id, hash)
+    record_job(hash, job_id)
 
     target_path = Path(TXT_ROOT, target)
     if target_path.exists():
         target_path.unlink()
+    clear_verification(target_path)
+
+
+def restore_query(config, target):
+    '''Re-uses an earlier job with the same hash instead of running the query again.
+
+    If the store still has that job's output, it is restored locally too.
+    '''
+    _, hash = prepare_query(config, target)
+    entry = load_entry(hash)
+    if entry is None or not entry['jobs']:
+        return False
+
+    job_id = entry['jobs'][-1]
+    finish_query(target, job_id, hash)
+
+    target_path = Path(TXT_ROOT, target)
+    entry = restore_output(hash, target_path)
+    if entry is not None:
+        logger.info(f'Restored output of {target} from job {job_id} in the local store.')
+        save_verification(target_path, job_id, entry['md5'], detect_compression(target_path))
+    else:
+        logger.info(f'Re-using earlier job {job_id} for {target}.')
+    return True
+
+
+def run_query(config, target, timeout=None):
+    logger.info('Running query again...')
+
+    job, hash = submit_query(config, target)
+    with Timer():
+        result = wait_for_jobs([job], job_timeout=timeout)[0]
+    if isinstance(result, Exception):
+        logger.error(str(result))
+        logger.error(f'See url: {job.get_url()}')
+        exit(24)
+    logger.debug(f'Job {job.id} is complete.')
+    record_phases(target, job, result)
+
+    status = check_job(job)
+    if status != 0:
+        exit(status)
+
+    finish_query(target, job.id, hash)
 
 
 def download_query(config, target):
@@ -48,31 +98,97 @@ def download_query(config, target):
     job.set_public(get_make_public(config, target))
 
     target_path.parent.mkdir(parents=True, exist_ok=True)
+    digest = None
     try:
-        with Timer():
-            with target_path.open(mode='w') as fh:
-                fh.write(job.output())
+        with Timer('download', target, job=job.id) as timer:
+            digest = download_output(job, target_path, compression=get_compression(config, target))
+            timer.values['bytes'] = digest[0]
     except Exception as e:
-        target_path.unlink()
         print(e)
         exit(30)
     finally:
-        verifyDownload(target)
+        verifyDownload(target, digest)
+
 
+def get_verification_path(target_path):
+    return target_path.with_name(target_path.name + '.verified')
 
-def verifyDownload(target):
+
+def get_verification(target_path, job_id):
+    try:
+        with get_verification_path(target_path).open(mode='r') as fh:
+            record = json.load(fh)
+        stat = target_path.stat()
+        if record['job'] == job_id \
+                and record['size'] == stat.st_size \
+                and record['mtime'] == stat.st_mtime_ns \
+                and record['inode'] == stat.st_ino:
+            return record
+    except Exception:
+        pass
+    return None
+
+
+def save_verification(target_path, job_id, hash, compression=None):
+    stat = target_path.stat()
+    record = {
+        'job': job_id,
+        'size': stat.st_size,
+        'mtime': stat.st_mtime_ns,
+        'inode': stat.st_ino,
+        'md5': hash,
+        'compression': compression,
+    }
+    with get_verification_path(target_path).open(mode='w') as fh:
+        json.dump(record, fh, indent=2)
+
+
+def clear_verification(target_path):
+    get_verification_path(target_path).unlink(missing_ok=True)
+
+
+def verifyDownload(target, digest=None):
+    '''Verifies a downloaded output against its Boa job.
+
+    If a verification record exists and the file is unchanged since it was
+    written, no network calls or hashing are performed.  For compressed
+    outputs the record holds the compressed size, while the size and hash
+    checked against Boa are of the uncompressed contents.
+
+    Args:
+        target (str): the output target, without the 'data/txt/' prefix
+        digest (Optional[Tuple[int, str]]): the uncompressed (size, MD5) computed while downloading, if known
+    '''
     target_path = Path(TXT_ROOT, target)
+    start = time.perf_counter()
 
     if not target_path.exists():
+        clear_verification(target_path)
         return False
 
     try:
-        job_data = get_query_data()
+        job_id = get_query_data()[target]['job']
+        job_hash = get_query_data()[target]['job-hash']
+
+        record = get_verification(target_path, job_id)
+        if record is not None:
+            logger.debug(f'Output of {target} is unchanged since it was last verified.')
+            target_path.touch()
+            save_verification(target_path, job_id, record['md5'], record.get('compression'))
+            put_output(job_hash, job_id, target_path, record['md5'])
+            record_metric('verify', target, time.perf_counter() - start, cached=True)
+            return True
+
+        clear_verification(target_path)
 
         client = get_client()
-        job = client.get_job(job_data[target]['job'])
+        job = client.get_job(job_id)
+
+        compression = detect_compression(target_path)
+        if compression is not None and digest is None:
+            digest = output_digest(target_path)
 
-        actual_size = target_path.stat().st_size
+        actual_size = target_path.stat().st_size if compression is None else digest[0]
         expected_size = int(job.output_size())
         if actual_size != expected_size:
             logger.warning(f'Downloaded output of {target} is {actual_size}, should be {expected_size}, deleting.')
@@ -80,9 +196,13 @@ def verifyDownload(target):
             return False
 
         expected_hash = job.output_hash()
-        with target_path.open(mode='rb') as fh:
-            data = fh.read(expected_hash[0])
-        actual_hash = md5(data).hexdigest()
+        if digest is not None and digest[0] == expected_hash[0]:
+            actual_hash = digest[1]
+        elif compression is not None:
+            # Boa hashes the first bytes of the uncompressed output
+            actual_hash = output_digest(target_path, expected_hash[0])[1]
+        else:
+            actual_hash = file_md5(target_path, expected_hash[0]).hexdigest()
         if expected_hash[1] != actual_hash:
             logger.warning(f'Downloaded output of {target} has bad hash ({actual_hash}, was expecting {expected_hash[1]}), deleting.')
             target_path.unlink()
@@ -93,6 +213,9 @@ def verifyDownload(target):
         raise e
 
     target_path.touch()
+    save_verification(target_path, job_id, actual_hash, compression)
+    put_output(job_hash, job_id, target_path, actual_hash)
+    record_metric('verify', target, time.perf_counter() - start, cached=False, bytes=actual_size)
     return True
 
 
@@ -100,6 +223,8 @@ if __name__ == '__main__':
     from argparse import ArgumentParser
     parser = ArgumentParser()
     parser.add_argument('--verbose', '-v', action='count', default=0)
+    parser.add_argument('--timeout', type=float, default=None,
+                        help='seconds to wait for the Boa job before giving up')
     parser.add_argument('target')
     args = parser.parse_args()
 
@@ -114,8 +239,8 @@ if __name__ == '__main__':
         print(f'The download target {target} is not in the study-config.json.')
         exit(3)
 
-    if is_run_needed(config, target):
-        run_query(config, target)
+    if is_run_needed(config, target) and not restore_query(config, target):
+        run_query(config, target, args.timeout)
 
     if not verifyDownload(target):
         download_query(config, target)
@@ -3,6 +3,65 @@
 
 import os
 import sys
+from boaio import iter_output_blocks
+from boaparse import WRITE_BUFFER_SIZE
+from utilities import Timer
+
+
+def write_dupes(blocks, out):
+    '''Writes every run of consecutive lines with the same hash (the first
+    index) to 'out'.
+
+    Lines are never decoded: only each line's hash is sliced out to compare,
+    and runs are written as slices of the block they are in.
+
+    Returns:
+        int: the number of lines read
+    '''
+    lines = 0
+    last = None
+    run_lines = 0
+    # the run's only line, if it started in an earlier block
+    pending = None
+
+    for block in blocks:
+        if b'\r' in block:
+            block = block.replace(b'\r\n', b'\n').replace(b'\r', b'\n')
+        view = memoryview(block)
+        size = len(block)
+        # where the current run started in this block, if it did
+        run_start = 0 if run_lines > 1 else None
+
+        pos = 0
+        while pos < size:
+            end = block.find(b'\n', pos) + 1 or size
+            idx = block.find(b']', pos, end)
+            current = block[pos + 2:idx if idx > -1 else end - 1]
+
+            if current == last:
+                run_lines += 1
+                if run_start is None:
+                    out.write(pending)
+                    pending = None
+                    run_start = pos
+            else:
+                if run_lines > 1:
+                    out.write(view[run_start:pos])
+                last = current
+                run_lines = 1
+                run_start = pos
+
+            lines += 1
+            pos = end
+
+        if run_lines > 1:
+            out.write(view[run_start:size])
+        elif run_start is not None:
+            pending = block[run_start:size]
+        view.release()
+
+    return lines
+
 
 if __name__ == '__main__':
     filesize = os.path.getsize(sys.argv[1])
@@ -13,26 +72,9 @@ if __name__ == '__main__':
         pbar = None
 
     try:
-        with open(sys.argv[1], 'r') as f:
-            last = None
-            lastline = None
-
-            line = f.readline()
-            while line:
-                if pbar is not None:
-                    pbar.update(len(line))
-                current = line[2:line.find(']')]
-
-                if current == last:
-                    if lastline:
-                        print(lastline, end='')
-                        lastline = None
-                    print(line, end='')
-                else:
-                    lastline = line
-
-                last = current
-                line = f.readline()
+        with Timer('gendupes', sys.argv[1], bytes=filesize) as timer, \
+                open(sys.stdout.fileno(), 'wb', buffering=WRITE_BUFFER_SIZE, closefd=False) as out:
+            timer.values['rows'] = write_dupes(iter_output_blocks(sys.argv[1], progress=pbar.update if pbar is not None else None), out)
     finally:
         if pbar is not None:
             pbar.close()
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+import json
+from utilities import METRICS_JSONL
+
+
+def load_metrics(filename):
+    metrics = []
+    with open(filename, 'r') as fh:
+        for line in fh:
+            line = line.strip()
+            if line:
+                try:
+                    metrics.append(json.loads(line))
+                except ValueError:
+                    pass
+    return metrics
+
+
+def format_rate(amount, seconds, unit):
+    if not amount or not seconds:
+        return ''
+    rate = amount / seconds
+    for prefix in ['', 'K', 'M', 'G']:
+        if rate < 1000:
+            break
+        rate /= 1000
+    return f'{rate:0.1f} {prefix}{unit}/s'
+
+
+def summarize_stages(metrics):
+    stages = {}
+    for m in metrics:
+        s = stages.setdefault(m['stage'], {'count': 0, 'seconds': 0.0, 'max': 0.0, 'bytes': 0, 'rows': 0})
+        seconds = m.get('seconds', 0.0)
+        s['count'] += 1
+        s['seconds'] += seconds
+        s['max'] = max(s['max'], seconds)
+        s['bytes'] += m.get('bytes', 0)
+        s['rows'] += m.get('rows', 0)
+    return sorted(stages.items(), key=lambda x: x[1]['seconds'], reverse=True)
+
+
+def print_stages(metrics):
+    print(f'{"stage":<16} {"count":>6} {"total (s)":>12} {"mean (s)":>10} {"max (s)":>10}  throughput')
+    for stage, s in summarize_stages(metrics):
+        throughput = ', '.join(x for x in [format_rate(s['bytes'], s['seconds'], 'B'),
+                                           format_rate(s['rows'], s['seconds'], 'rows')] if x)
+        print(f'{stage:<16} {s["count"]:>6} {s["seconds"]:>12.2f} {s["seconds"] / s["count"]:>10.2f} {s["max"]:>10.2f}  {throughput}')
+
+
+def print_slowest(metrics, top):
+    print(f'{"stage":<16} {"seconds":>10}  target')
+    for m in sorted(metrics, key=lambda x: x.get('seconds', 0.0), reverse=True)[:top]:
+        print(f'{m["stage"]:<16} {m.get("seconds", 0.0):>10.2f}  {m.get("target")}')
+
+
+def print_trend(metrics, runs):
+    totals = {}
+    for m in metrics:
+        run = totals.setdefault(m.get('run') or '?', {})
+        run[m['stage']] = run.get(m['stage'], 0.0) + m.get('seconds', 0.0)
+
+    run_ids = sorted(totals)[-runs:]
+    stages = sorted({stage for run in run_ids for stage in totals[run]})
+
+    print(f'{"run":<18} ' + ' '.join(f'{stage:>12}' for stage in stages))
+    for run in run_ids:
+        print(f'{run:<18} ' + ' '.join(f'{totals[run][stage]:>12.2f}' if stage in totals[run] else f'{"-":>12}' for stage in stages))
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+    parser = ArgumentParser()
+    parser.add_argument('--file', '-f', default=METRICS_JSONL,
+                        help='the metrics file to report on')
+    parser.add_argument('--run', default=None,
+                        help='the run to report on (defaults to the latest run)')
+    parser.add_argument('--top', type=int, default=10,
+                        help='how many of the slowest individual steps to list')
+    parser.add_argument('--runs', type=int, default=10,
+                        help='how many recent runs to show in the trend')
+    args = parser.parse_args()
+
+    try:
+        metrics = load_metrics(args.file)
+    except FileNotFoundError:
+        print(f'No metrics have been recorded in "{args.file}" yet.')
+        exit(1)
+    if not metrics:
+        print(f'No metrics have been recorded in "{args.file}" yet.')
+        exit(1)
+
+    run = args.run or max(m.get('run') or '?' for m in metrics)
+    latest = [m for m in metrics if (m.get('run') or '?') == run]
+
+    print(f'== Stages for run {run}')
+    print_stages(latest)
+    print('')
+    print(f'== Slowest steps for run {run}')
+    print_slowest(latest, args.top)
+    print('')
+    print(f'== Total seconds per stage over the last {args.runs} runs')
+    print_trend(metrics, args.runs)
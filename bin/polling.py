@@ -0,0 +1,113 @@
+# coding: utf-8
+
+# Waits on Boa jobs from an asyncio event loop, polling each job with an
+# adaptive backoff instead of blocking in job.wait().
+
+import asyncio
+from boaapi.status import CompilerStatus, ExecutionStatus
+from utilities import logger, record_metric
+
+POLL_MIN_INTERVAL = 2
+POLL_MAX_INTERVAL = 60
+POLL_BACKOFF = 1.5
+
+
+# metric stage names for each job phase
+PHASE_STAGES = {
+    'queued': 'queue',
+    'compiling': 'compile',
+    'running': 'execute',
+}
+
+
+class JobTimeout(Exception):
+    pass
+
+
+def get_job_phase(job):
+    if job.compiler_status is CompilerStatus.ERROR or job.exec_status is ExecutionStatus.ERROR:
+        return 'error'
+    if job.compiler_status is CompilerStatus.WAITING:
+        return 'queued'
+    if job.compiler_status is CompilerStatus.RUNNING:
+        return 'compiling'
+    if job.exec_status is ExecutionStatus.WAITING:
+        return 'queued'
+    if job.exec_status is ExecutionStatus.RUNNING:
+        return 'running'
+    return 'finished'
+
+
+async def wait_for_job(job, timeout=None, min_interval=POLL_MIN_INTERVAL, max_interval=POLL_MAX_INTERVAL):
+    '''Waits for a job to finish, polling less often the longer it stays in the same phase.
+
+    Args:
+        job (JobHandle): the job to wait on
+        timeout (Optional[float]): seconds to wait before raising JobTimeout. Defaults to None (no timeout).
+
+    Returns:
+        Dict[str, float]: the seconds spent in each phase ('queued', 'compiling', 'running')
+    '''
+    loop = asyncio.get_running_loop()
+    start = last_change = loop.time()
+    phase = None
+    phases = {}
+    interval = min_interval
+
+    while True:
+        now = loop.time()
+        new_phase = get_job_phase(job)
+        if new_phase != phase:
+            if phase is not None:
+                phases[phase] = phases.get(phase, 0) + now - last_change
+                logger.debug(f'Job {job.id} was {phase} for {now - last_change:0.0f} seconds.')
+            logger.info(f'Job {job.id} is {new_phase}.')
+            phase = new_phase
+            last_change = now
+            interval = min_interval
+
+        if not job.is_running():
+            return phases
+
+        remaining = None if timeout is None else timeout - (now - start)
+        if remaining is not None and remaining <= 0:
+            raise JobTimeout(f'Job {job.id} is still {phase} after {timeout} seconds.')
+
+        await asyncio.sleep(interval if remaining is None else min(interval, remaining))
+        interval = min(interval * POLL_BACKOFF, max_interval)
+        job.refresh()
+
+
+async def wait_for_all(jobs, timeout=None, job_timeout=None):
+    '''Waits on many jobs at once.
+
+    Returns:
+        list: for each job, either its phase timings or the exception that ended the wait
+    '''
+    if not jobs:
+        return []
+
+    tasks = [asyncio.create_task(wait_for_job(job, job_timeout)) for job in jobs]
+    _, pending = await asyncio.wait(tasks, timeout=timeout)
+    for task in pending:
+        task.cancel()
+
+    results = []
+    for job, task in zip(jobs, tasks):
+        if task in pending:
+            results.append(JobTimeout(f'Job {job.id} did not finish within the overall timeout of {timeout} seconds.'))
+        elif task.exception() is not None:
+            results.append(task.exception())
+        else:
+            results.append(task.result())
+    return results
+
+
+def record_phases(target, job, phases):
+    for phase, seconds in phases.items():
+        if phase in PHASE_STAGES:
+            record_metric(PHASE_STAGES[phase], target, seconds, job=job.id)
+
+
+def wait_for_jobs(jobs, timeout=None, job_timeout=None):
+    return asyncio.run(wait_for_all(jobs, timeout, job_timeout))
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+import os
+import runpy
+import sys
+import traceback
+from utilities import *
+
+MEMO_MB = 1024
+
+
+def reset_plots():
+    '''Closes any figures and restores the default plot settings, so each
+    analysis starts like it would in a new process.'''
+    if 'matplotlib.pyplot' in sys.modules:
+        import matplotlib
+        from matplotlib import pyplot as plt
+        plt.close('all')
+        matplotlib.rc_file_defaults()
+
+
+def run_analysis(script):
+    '''Runs an analysis script as if it was run with '$(PYTHON) analyses/<script>'.
+
+    Returns:
+        bool: if it ran without an error
+    '''
+    path = ANALYSIS_ROOT + script
+    argv = sys.argv
+    sys.argv = [path]
+    try:
+        with Timer('analysis', script):
+            runpy.run_path(path, run_name='__main__')
+        return True
+    except SystemExit as e:
+        if e.code is None or e.code == 0:
+            return True
+        logger.error(f'{script} exited with status {e.code}')
+        return False
+    except Exception:
+        logger.error(f'{script} failed:\n{traceback.format_exc()}')
+        return False
+    finally:
+        sys.argv = argv
+        reset_plots()
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+    parser = ArgumentParser(description='runs analyses in one process, so tables they share are only loaded once')
+    parser.add_argument('--verbose', '-v', action='count', default=0)
+    parser.add_argument('--keep-going', '-k', action='store_true',
+                        help='run the remaining analyses after one fails')
+    parser.add_argument('analyses', nargs='*',
+                        help='analysis scripts to run (defaults to all enabled analyses in study-config.json)')
+    args = parser.parse_args()
+
+    verbosity = min(max(3 - args.verbose, 1), 3) * 10
+    logger.setLevel(verbosity)
+
+    config = get_query_config()
+    analyses = [x[len(ANALYSIS_ROOT):] if x.startswith(ANALYSIS_ROOT) else x for x in args.analyses] or get_enabled_analyses(config)
+
+    for script in analyses:
+        if script not in config.get('analyses', {}):
+            print(f'The analysis {script} is not in the study-config.json.')
+            exit(3)
+
+    # analyses import the common library from their own folder
+    sys.path.insert(0, os.path.abspath(ANALYSIS_ROOT))
+    # keep loaded tables in memory, so analyses that share an input only load it once
+    os.environ.setdefault('BOA_DF_MEMO_MB', str(MEMO_MB))
+
+    failed = []
+    for script in analyses:
+        print(f'Running {ANALYSIS_ROOT}{script}', flush=True)
+        if not run_analysis(script):
+            failed.append(script)
+            if not args.keep_going:
+                break
+
+    if failed:
+        logger.critical('Failed analyses: ' + ', '.join(failed))
+        exit(1)
@@ -2,20 +2,27 @@
 # coding: utf-8
 
 from boaapi.status import CompilerStatus, ExecutionStatus
+from polling import record_phases, wait_for_jobs
 from utilities import *
 
 
-def run_query(target, dataset):
+def run_query(target, dataset, timeout=None):
     client = get_client()
 
     with open(target, 'r') as fh:
         query = fh.read()
-    job = client.query(query, client.get_dataset(dataset))
+    with Timer('submit', target):
+        job = client.query(query, client.get_dataset(dataset))
 
     logger.debug(f'Job {job.id} is running...')
     with Timer():
-        job.wait()
+        result = wait_for_jobs([job], job_timeout=timeout)[0]
+    if isinstance(result, Exception):
+        logger.error(str(result))
+        logger.error(f'See url: {job.get_url()}')
+        exit(24)
     logger.debug(f'Job {job.id} is complete.')
+    record_phases(target, job, result)
 
     if job.compiler_status is CompilerStatus.ERROR:
         logger.error(f'Job {job.id} had a compilation error.')
@@ -34,9 +41,8 @@ def download_query(job, output):
     logger.info(f'Downloading query output "{output}"...')
 
     try:
-        with Timer():
-            with open(output, mode='w') as fh:
-                fh.write(job.output())
+        with Timer('download', output, job=job.id) as timer:
+            timer.values['bytes'] = download_output(job, output)[0]
     except Exception as e:
         print(e)
         exit(30)
@@ -47,6 +53,8 @@ if __name__ == '__main__':
     parser = ArgumentParser()
     parser.add_argument('--output', '-o', action='store', required=True)
     parser.add_argument('--verbose', '-v', action='count', default=3)
+    parser.add_argument('--timeout', type=float, default=None,
+                        help='seconds to wait for the Boa job before giving up')
     parser.add_argument('queryfile')
     parser.add_argument('dataset')
     args = parser.parse_args()
@@ -55,7 +63,7 @@ if __name__ == '__main__':
     logger.setLevel(verbosity)
     logger.info(f'Setting verbosity to {verbosity}')
 
-    job = run_query(args.queryfile, args.dataset)
+    job = run_query(args.queryfile, args.dataset, args.timeout)
     download_query(job, args.output)
 
     close_client()
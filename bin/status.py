@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+from download import get_verification
+from pathlib import Path
+from utilities import *
+
+
+def get_status(config, target):
+    query_data = get_query_data()
+
+    if target not in query_data:
+        return 'never run'
+    if is_run_needed(config, target):
+        return 'stale'
+
+    target_path = Path(TXT_ROOT, target)
+    if not target_path.exists():
+        return 'not downloaded'
+    if get_verification(target_path, query_data[target]['job']) is None:
+        return 'not verified'
+    return 'up to date'
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+    parser = ArgumentParser()
+    parser.add_argument('--verbose', '-v', action='count', default=0)
+    parser.add_argument('targets', nargs='*',
+                        help='targets to check (defaults to all queries in study-config.json)')
+    args = parser.parse_args()
+
+    verbosity = min(max(3 - args.verbose, 1), 3) * 10
+    logger.setLevel(verbosity)
+
+    config = get_query_config()
+    targets = [x[len(TXT_ROOT):] if x.startswith(TXT_ROOT) else x for x in args.targets] or list(config['queries'])
+
+    for target in targets:
+        if target not in config['queries']:
+            print(f'The target {target} is not in the study-config.json.')
+            exit(3)
+
+    with Timer():
+        statuses = {target: get_status(config, target) for target in targets}
+
+    width = max(len(TXT_ROOT + x) for x in targets)
+    for target, status in statuses.items():
+        print(f'{TXT_ROOT + target:<{width}}  {status}')
+
+    if any(status != 'up to date' for status in statuses.values()):
+        exit(1)
@@ -0,0 +1,134 @@
+# coding: utf-8
+
+# A content-addressed store of verified query outputs, keyed by job hash.
+# Each entry in 'data/store/<job-hash>/' lists every job run for that hash and
+# (until evicted) holds the output, hard-linked with 'data/txt/' if possible.
+
+import json
+import os
+import shutil
+import time
+from pathlib import Path
+from utilities import STORE_ROOT, logger
+
+STORE_MAX_SIZE = os.environ.get('BOA_STORE_MAX_SIZE', '50G')
+
+
+def parse_size(size):
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+    size = str(size).strip().upper().rstrip('B')
+    if size and size[-1] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(size)
+
+
+def get_entry_path(hash):
+    return Path(STORE_ROOT, hash)
+
+
+def get_output_path(hash):
+    return get_entry_path(hash) / 'output.txt'
+
+
+def load_entry(hash):
+    try:
+        with (get_entry_path(hash) / 'meta.json').open(mode='r') as fh:
+            return json.load(fh)
+    except (OSError, ValueError):
+        return None
+
+
+def save_entry(hash, entry):
+    entry_path = get_entry_path(hash)
+    entry_path.mkdir(parents=True, exist_ok=True)
+    tmp = entry_path / f'meta.json.{os.getpid()}.tmp'
+    with tmp.open(mode='w') as fh:
+        json.dump(entry, fh, indent=2)
+    os.replace(tmp, entry_path / 'meta.json')
+
+
+def record_job(hash, job_id):
+    entry = load_entry(hash) or {'jobs': [], 'size': None, 'md5': None}
+    if job_id not in entry['jobs']:
+        entry['jobs'].append(job_id)
+    entry['used'] = time.time()
+    save_entry(hash, entry)
+
+
+def _link(source, dest):
+    tmp = dest.with_name(f'{dest.name}.{os.getpid()}.tmp')
+    try:
+        os.link(source, tmp)
+    except OSError:
+        shutil.copyfile(source, tmp)
+    os.replace(tmp, dest)
+
+
+def put_output(hash, job_id, source, md5):
+    '''Adds a verified output to the store, then evicts old outputs if needed.'''
+    record_job(hash, job_id)
+    entry = load_entry(hash)
+
+    output_path = get_output_path(hash)
+    # outputs are stored by job hash, so one of the same size and md5 (e.g. a
+    # copy, if it could not be linked) is already the same output
+    if output_path.exists() and (os.path.samefile(source, output_path)
+                                 or (entry['md5'] == md5 and entry['size'] == os.path.getsize(source))):
+        return
+
+    logger.debug(f'Storing output for job {job_id} in "{output_path}".')
+    _link(source, output_path)
+
+    entry['size'] = output_path.stat().st_size
+    entry['md5'] = md5
+    save_entry(hash, entry)
+
+    evict(parse_size(STORE_MAX_SIZE), keep=hash)
+
+
+def restore_output(hash, target_path):
+    '''Links a stored output onto the target path, if the store has one.
+
+    Returns:
+        the store entry, or None if there is no output stored for the hash
+    '''
+    entry = load_entry(hash)
+    output_path = get_output_path(hash)
+    if entry is None or entry.get('md5') is None or not output_path.exists():
+        return None
+
+    target_path.parent.mkdir(parents=True, exist_ok=True)
+    _link(output_path, target_path)
+
+    entry['used'] = time.time()
+    save_entry(hash, entry)
+    return entry
+
+
+def evict(max_size, keep=None):
+    '''Removes the least recently used outputs until the store fits in max_size bytes.
+
+    Entries keep their list of jobs, so an evicted output can still be
+    downloaded again from an earlier job without re-running it.
+    '''
+    if not os.path.exists(STORE_ROOT):
+        return
+
+    entries = []
+    for hash in os.listdir(STORE_ROOT):
+        entry = load_entry(hash)
+        if entry is not None and get_output_path(hash).exists():
+            entries.append((entry.get('used', 0), hash, entry))
+
+    total = sum(entry['size'] or 0 for (_, _, entry) in entries)
+    for (_, hash, entry) in sorted(entries, key=lambda x: x[0]):
+        if total <= max_size:
+            break
+        if hash == keep:
+            continue
+        logger.info(f'Evicting stored output "{get_output_path(hash)}".')
+        get_output_path(hash).unlink()
+        total -= entry['size'] or 0
+        entry['size'] = None
+        entry['md5'] = None
+        save_entry(hash, entry)
@@ -8,6 +8,8 @@ import time
 
 STUDY_JSON = 'study-config.json'
 JOBS_JSON = 'jobs.json'
+STUDY_CACHE = '.study-cache.json'
+STUDY_CACHE_VERSION = 1
 
 QUERY_ROOT = 'boa/'
 SNIPPET_ROOT = QUERY_ROOT + 'snippets/'
@@ -16,11 +18,19 @@ DATA_ROOT = 'data/'
 TXT_ROOT = DATA_ROOT + 'txt/'
 CSV_ROOT = DATA_ROOT + 'csv/'
 PQ_ROOT = DATA_ROOT + 'parquet/'
+STORE_ROOT = DATA_ROOT + 'store/'
 
 ANALYSIS_ROOT = 'analyses/'
 
+METRICS_JSONL = os.environ.get('BOA_METRICS_FILE', DATA_ROOT + 'metrics.jsonl')
+RUN_ID = os.environ.get('BOA_RUN_ID', time.strftime('%Y%m%d-%H%M%S'))
+
 ADMIN_PREFIX = '[admin] '
 
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+SESSION_SOCKET = os.environ.get('BOA_SESSION_SOCKET', '.boa-session.sock')
+
 logger = logging.getLogger('boa.logger')
 logger.addHandler(logging.StreamHandler(sys.stderr))
 
@@ -48,6 +58,50 @@ def get_credentials():
     return (user, password)
 
 
+class SessionProxy:
+    '''Forwards Boa XML-RPC calls to a running bin/boa-session.py broker.
+
+    Used in place of a BoaClient's ServerProxy, so all of the boaapi client
+    and job handle logic still runs locally.
+    '''
+    def __init__(self, conn, name=None):
+        self._conn = conn
+        self._name = name
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return SessionProxy(self._conn, name if self._name is None else f'{self._name}.{name}')
+
+    def __call__(self, *args):
+        self._conn.send((self._name, args))
+        ok, result = self._conn.recv()
+        if not ok:
+            # the broker sends (faultCode, faultString) for Boa faults, and
+            # (type name, message) for any other error
+            error, message = result
+            if isinstance(error, int):
+                import xmlrpc.client
+                raise xmlrpc.client.Fault(error, message)
+            raise Exception(f'{error}: {message}')
+        return result
+
+    def _disconnect(self):
+        self._conn.close()
+
+
+def connect_session():
+    if not os.path.exists(SESSION_SOCKET):
+        return None
+
+    try:
+        from multiprocessing.connection import Client
+        return SessionProxy(Client(SESSION_SOCKET, family='AF_UNIX'))
+    except OSError:
+        logger.debug(f'Boa session broker at "{SESSION_SOCKET}" is not responding, logging in directly.')
+        return None
+
+
 client = None
 
 
@@ -56,7 +110,14 @@ def get_client():
     if client is None:
         from boaapi.boa_client import BoaClient, BOA_API_ENDPOINT
         client = BoaClient(endpoint=BOA_API_ENDPOINT)
-        client.login(*get_credentials())
+        session = connect_session()
+        if session is not None:
+            logger.debug(f'Using Boa session broker at "{SESSION_SOCKET}".')
+            client.server = session
+            # the broker is already logged in and ignores these credentials
+            client.login('', '')
+        else:
+            client.login(*get_credentials())
     return client
 
 
@@ -64,9 +125,122 @@ def close_client():
     global client
     if client:
         client.close()
+        if isinstance(client.server, SessionProxy):
+            client.server._disconnect()
     client = None
 
 
+def file_md5(path, limit=None, chunk_size=DOWNLOAD_CHUNK_SIZE):
+    '''Computes the MD5 of a file (or its first 'limit' bytes) in fixed-size chunks.
+
+    Returns:
+        the hashlib MD5 object, so callers can keep updating it
+    '''
+    from hashlib import md5
+
+    hasher = md5()
+    remaining = limit
+    with open(path, mode='rb') as fh:
+        while remaining is None or remaining > 0:
+            chunk = fh.read(chunk_size if remaining is None else min(chunk_size, remaining))
+            if not chunk:
+                break
+            hasher.update(chunk)
+            if remaining is not None:
+                remaining -= len(chunk)
+    return hasher
+
+
+def get_output_url(job):
+    return get_client().server.job.output(job.id)
+
+
+def download_output(job, target_path, url=None, chunk_size=DOWNLOAD_CHUNK_SIZE, compression=None):
+    '''Streams a finished job's output to disk without holding it in memory.
+
+    The output is written to a '.part' file next to the target, which is
+    atomically renamed onto the target once complete.  If a partial file for
+    the same job already exists, the download resumes where it left off.
+
+    If 'compression' is given ('gzip' or 'zstd'), the completed output is
+    stored compressed under the target's name instead.
+
+    If the output 'url' is given, no Boa API calls are made, so the transfer
+    can safely run on a worker thread.
+
+    Returns:
+        (int, str): the size of the output and its MD5 hash
+    '''
+    from hashlib import md5
+    from pathlib import Path
+    from urllib.error import HTTPError
+    from urllib.request import Request, urlopen
+
+    target_path = Path(target_path)
+    part_path = target_path.with_name(f'{target_path.name}.{job.id}.part')
+
+    if url is None:
+        url = get_output_url(job)
+
+    offset = part_path.stat().st_size if part_path.exists() else 0
+    if offset > 0:
+        logger.info(f'Resuming download of job {job.id} at byte {offset}...')
+        hasher = file_md5(part_path, chunk_size=chunk_size)
+    else:
+        hasher = md5()
+
+    request = Request(url, headers={'Accept-Encoding': 'identity'})
+    if offset > 0:
+        request.add_header('Range', f'bytes={offset}-')
+
+    try:
+        response = urlopen(request)
+    except HTTPError as e:
+        if e.code != 416:
+            raise
+        # the partial file already holds the entire output
+        response = None
+
+    size = offset
+    if response is not None:
+        with response:
+            if offset > 0 and response.status != 206:
+                logger.info('Server does not support resuming downloads, restarting...')
+                offset = size = 0
+                hasher = md5()
+
+            length = response.headers.get('Content-Length')
+            total = offset + int(length) if length is not None else None
+
+            try:
+                from tqdm import tqdm
+                pbar = tqdm(total=total, initial=offset, unit='B', unit_scale=True, unit_divisor=1024) if total is None or total > 250000 else None
+            except ImportError:
+                pbar = None
+
+            try:
+                with part_path.open(mode='ab' if offset > 0 else 'wb') as fh:
+                    for chunk in iter(lambda: response.read(chunk_size), b''):
+                        fh.write(chunk)
+                        hasher.update(chunk)
+                        size += len(chunk)
+                        if pbar is not None:
+                            pbar.update(len(chunk))
+            finally:
+                if pbar is not None:
+                    pbar.close()
+
+    if compression is not None:
+        from boaio import compress_file
+        compressed_size = compress_file(part_path, target_path, compression)
+        part_path.unlink()
+        logger.debug(f'Compressed output with {compression} to {compressed_size} bytes.')
+    else:
+        os.replace(part_path, target_path)
+    logger.debug(f'Downloaded {size} bytes (md5 {hasher.hexdigest()}) to "{target_path}".')
+    return (size, hasher.hexdigest())
+
+
 config = None
 
 
@@ -111,22 +285,159 @@ def update_query_data(target, job_id, hash):
     os.chmod(JOBS_JSON, 0o444)
 
 
-def expand_replacements(replacements, query):
-    if len(replacements) > 0:
+class TemplateExpander:
+    '''Expands {@...@} substitution targets in a query.
+
+    The queries are exactly those of the original regex-based expansion, so
+    job hashes do not change.  It replaced targets in passes: in each pass,
+    every target in turn, and only the last occurrence of a target on each
+    line.  Replacements are stripped, and their continuation lines indented
+    like the line the target is on at that point, which can be the last line
+    of a replacement made earlier on it.
+
+    Rather than searching the whole query for each target in each pass, the
+    expander keeps the occurrences of each target and the line each is on.
+
+    Expanded snippets are not memoized, only split into lines and targets
+    once.  How a snippet expands depends on where it lands: the targets left
+    on its first and last lines are replaced in passes with the targets
+    around it, and the order decides how the lines after them are indented.
+    '''
+    class _Line:
+        __slots__ = ('items', 'next')
+
+        def __init__(self, items, next=None):
+            self.items = items
+            self.next = next
+
+    class _Target:
+        __slots__ = ('target', 'line', 'stack')
+
+        def __init__(self, target, stack):
+            self.target = target
+            self.stack = stack
+
+    def __init__(self, replacements):
         import re
-        has_replaced = True
-        while has_replaced:
-            has_replaced = False
-            for (before, after) in replacements:
-                after = (r'\g<1>\g<2>' + after.strip()).replace('\n', '\n\\1') + r'\3'
-                before = re.sub(r'([{}])', r'\\\1', before)
-                replaced = re.sub(r'([ \t]*)(.*(?=' + before + '))' + before + '(\n?)',
-                                  after,
-                                  query).replace('#WHY#', '\\')
-                if query != replaced:
-                    has_replaced = True
-                    query = replaced
-    return query
+
+        self.replacements = {}
+        for target, replacement in replacements:
+            if target:
+                self.replacements.setdefault(target, replacement)
+        targets = sorted(self.replacements, key=len, reverse=True)
+        self.pattern = re.compile('|'.join(re.escape(x) for x in targets)) if targets else None
+        self.split = {}
+
+    def expand(self, text):
+        if self.pattern is None or not self.pattern.search(text):
+            return text
+
+        live = {target: [] for target in self.replacements}
+        head = None
+        for items in reversed(self._instantiate(self._split(text), (), live)):
+            head = self._Line(items, head)
+            self._attach(head, items)
+
+        while any(live.values()):
+            for target in self.replacements:
+                if not live[target]:
+                    continue
+                # only the last occurrence on each line is replaced in a pass
+                last = {}
+                for occurrence in live[target]:
+                    line = occurrence.line
+                    if id(line) not in last or line.items.index(occurrence) > line.items.index(last[id(line)]):
+                        last[id(line)] = occurrence
+                replaced = set(map(id, last.values()))
+                live[target] = [x for x in live[target] if id(x) not in replaced]
+                for occurrence in last.values():
+                    self._replace(occurrence, live)
+
+        out = []
+        while head is not None:
+            out.append(''.join(head.items))
+            head = head.next
+        return '\n'.join(out)
+
+    def _split(self, text):
+        '''Splits text into lines of literal strings and targets.'''
+        lines = []
+        for line in text.split('\n'):
+            items = []
+            pos = 0
+            for m in self.pattern.finditer(line):
+                items.append(line[pos:m.start()])
+                # a target, until it has an occurrence of its own
+                items.append((m.group(),))
+                pos = m.end()
+            items.append(line[pos:])
+            lines.append(items)
+        return lines
+
+    def _instantiate(self, lines, stack, live):
+        '''Copies split lines, with a new occurrence for each target.'''
+        copies = []
+        for items in lines:
+            copy = []
+            for item in items:
+                if isinstance(item, tuple):
+                    target = item[0]
+                    if target in stack:
+                        raise ValueError('Substitution cycle detected: ' + ' -> '.join(stack + (target,)))
+                    item = self._Target(target, stack)
+                    live[target].append(item)
+                copy.append(item)
+            copies.append(copy)
+        return copies
+
+    def _replace(self, occurrence, live):
+        target = occurrence.target
+        if target not in self.split:
+            self.split[target] = self._split(self.replacements[target].strip())
+        lines = self._instantiate(self.split[target], occurrence.stack + (target,), live)
+
+        line = occurrence.line
+        i = line.items.index(occurrence)
+        after = line.items[i + 1:]
+        indent = self._indent(line.items)
+        del line.items[i:]
+        line.items.extend(lines[0])
+        self._attach(line, lines[0])
+        for items in lines[1:]:
+            items.insert(0, indent)
+            line.next = self._Line(items, line.next)
+            line = line.next
+            self._attach(line, items)
+        line.items.extend(after)
+        self._attach(line, after)
+
+    def _attach(self, line, items):
+        for item in items:
+            if not isinstance(item, str):
+                item.line = line
+
+    @staticmethod
+    def _indent(items):
+        '''Gets the spaces and tabs a line starts with.'''
+        indent = []
+        for item in items:
+            if not isinstance(item, str):
+                break
+            stripped = item.lstrip(' \t')
+            indent.append(item[:len(item) - len(stripped)])
+            if stripped:
+                break
+        return ''.join(indent)
+
+
+expanders = {}
+
+
+def expand_replacements(replacements, query):
+    key = tuple(replacements)
+    if key not in expanders:
+        expanders[key] = TemplateExpander(replacements)
+    return expanders[key].expand(query)
 
 
 def build_replacements(global_replacements, local_replacements, only_files=False):
@@ -140,14 +451,14 @@ def build_replacements(global_replacements, local_replacements, only_files=False
                 if 'replacement' in repl:
                     replacement_includes_string = True
                     if not only_files:
-                        replacements[target] = repl['replacement'].replace('\\', '#WHY#')
+                        replacements[target] = repl['replacement']
                 else:
                     if only_files:
                         replacements[target] = SNIPPET_ROOT + repl['file']
                     else:
                         try:
                             with open(SNIPPET_ROOT + repl['file'], 'r') as fh:
-                                replacements[target] = fh.read().replace('\\', '#WHY#')
+                                replacements[target] = fh.read()
                         except FileNotFoundError as e:
                             raise FileNotFoundError(f"Snippet file '{repl['file']}' not found for substitution '{repl['target']}'.") from e
                 if target in replacements:
@@ -164,33 +475,193 @@ def get_make_public(config, target):
         return True
 
 
+def get_compression(config, target):
+    '''Returns how a query's output should be stored ('gzip' or 'zstd'), or None to store it plain.
+
+    Queries inherit the study's 'compression' unless they set their own.  If
+    zstd is requested but the 'zstandard' package is missing, gzip is used.
+    '''
+    compression = config['queries'][target].get('compression', config.get('compression', 'none'))
+    if compression == 'none':
+        return None
+    if compression == 'zstd':
+        from boaio import have_zstd
+        if not have_zstd():
+            logger.warning('The "zstandard" package is not installed, compressing with gzip instead.')
+            return 'gzip'
+    return compression
+
+
+def resolve_dataset(name):
+    client = get_client()
+    ds = client.get_dataset(name)
+    if ds is None:
+        ds = client.get_dataset(ADMIN_PREFIX + name)
+    return ds
+
+
 def get_dataset(config, target):
     dataset_name = config['queries'][target]['dataset']
 
     if dataset_name in config['datasets']:
-        client = get_client()
-        ds = client.get_dataset(config['datasets'][dataset_name])
-        if ds is None:
-            ds = client.get_dataset(ADMIN_PREFIX + config['datasets'][dataset_name])
-        return ds
+        return get_study_cache(config)['datasets'][config['datasets'][dataset_name]]
 
     logger.critical(f'Dataset named "{dataset_name}" is not known.')
     exit(20)
 
 
-def prepare_query(config, target):
-    from hashlib import sha256
+def get_query_inputs(config, target):
+    query_info = config['queries'][target]
+    inputs = [QUERY_ROOT + query_info['query']]
+    for (_, x) in build_replacements(config.get('substitutions', []), query_info.get('substitutions', []), only_files=True):
+        if x not in inputs:
+            inputs.append(x)
+    return inputs
+
+
+def get_enabled_analyses(config):
+    '''Gets the analysis scripts in the study config that are not disabled, in order.'''
+    analyses = config.get('analyses', {})
+    return [script for script in analyses if not analyses[script].get('disabled', False)]
+
+
+def get_split_vars(csv_info):
+    '''Gets the table each output variable is split into, if the output is
+    split by variable (see bin/boasplit.py).
+
+    Returns:
+        Optional[Dict[str, dict]]: each variable's table config, always as an object with an 'output'
+    '''
+    if isinstance(csv_info, str) or 'vars' not in csv_info:
+        return None
+    return {var: {'output': info} if isinstance(info, str) else info for var, info in csv_info['vars'].items()}
 
+
+def get_csv_outputs(csv_info):
+    '''Gets the files a 'csv' config converts an output to by default.'''
+    tables = get_split_vars(csv_info)
+    if tables is None:
+        tables = {None: csv_info}
+
+    outputs = []
+    for info in tables.values():
+        if isinstance(info, str):
+            outputs.append(CSV_ROOT + info)
+        elif info.get('format', 'csv') == 'parquet':
+            outputs.append(CSV_ROOT + info['output'][:-4] + '.parquet')
+        else:
+            outputs.append(CSV_ROOT + info['output'])
+    return outputs
+
+
+def get_query_outputs(config, target):
     query_info = config['queries'][target]
+    outputs = []
+    for info in [query_info] + list(query_info.get('processors', {}).values()):
+        if 'output' in info:
+            outputs.append(info['output'])
+        if 'csv' in info:
+            if get_split_vars(info['csv']) is None:
+                outputs.append(CSV_ROOT + (info['csv'] if isinstance(info['csv'], str) else info['csv']['output']))
+            outputs += [x for x in get_csv_outputs(info['csv']) if x not in outputs]
+    return outputs
+
+
+def _stat_inputs(paths):
+    stats = {}
+    for path in paths:
+        try:
+            st = os.stat(path)
+            stats[path] = [st.st_size, st.st_mtime_ns]
+        except OSError:
+            stats[path] = None
+    return stats
+
+
+def compile_study(config, old_cache=None):
+    '''Resolves the study config into a cache of expanded queries and hashes.
+
+    Only datasets not already resolved in 'old_cache' need a Boa login.
+    '''
+    from hashlib import sha256
+
+    datasets = dict(old_cache['datasets']) if old_cache is not None else {}
+    queries = {}
+    inputs = [STUDY_JSON]
+
+    for target, query_info in config['queries'].items():
+        dataset_name = query_info['dataset']
+        if dataset_name not in config['datasets']:
+            logger.critical(f'Dataset named "{dataset_name}" is not known.')
+            exit(20)
 
-    with open(QUERY_ROOT + query_info['query'], 'r') as fh:
-        query = fh.read()
+        boa_name = config['datasets'][dataset_name]
+        if boa_name not in datasets:
+            logger.debug(f'Resolving Boa dataset "{boa_name}"...')
+            datasets[boa_name] = resolve_dataset(boa_name)
+            if datasets[boa_name] is None:
+                logger.critical(f'Boa dataset "{boa_name}" could not be found.')
+                exit(20)
 
-    query_substitutions = build_replacements(config.get('substitutions', []),
-                                             query_info.get('substitutions', []))
-    query = expand_replacements(query_substitutions, query)
+        with open(QUERY_ROOT + query_info['query'], 'r') as fh:
+            query = fh.read()
 
-    return (query, sha256(str.encode(get_dataset(config, target)['name'] + query)).hexdigest())
+        query_substitutions = build_replacements(config.get('substitutions', []),
+                                                 query_info.get('substitutions', []))
+        query = expand_replacements(query_substitutions, query)
+
+        query_inputs = get_query_inputs(config, target)
+        inputs.extend(x for x in query_inputs if x not in inputs)
+
+        queries[target] = {
+            'query': query,
+            'hash': sha256(str.encode(datasets[boa_name]['name'] + query)).hexdigest(),
+            'inputs': query_inputs,
+            'outputs': get_query_outputs(config, target),
+        }
+
+    return {
+        'version': STUDY_CACHE_VERSION,
+        'inputs': _stat_inputs(inputs),
+        'datasets': datasets,
+        'queries': queries,
+    }
+
+
+study_cache = None
+
+
+def get_study_cache(config):
+    '''Gets the compiled study config, rebuilding it if any of its inputs changed.'''
+    global study_cache
+    if study_cache is not None:
+        return study_cache
+
+    old_cache = None
+    try:
+        with open(STUDY_CACHE, 'r') as fh:
+            old_cache = json.load(fh)
+        if old_cache.get('version') == STUDY_CACHE_VERSION \
+                and old_cache['inputs'] == _stat_inputs(old_cache['inputs']):
+            study_cache = old_cache
+            return study_cache
+    except Exception:
+        old_cache = None
+
+    logger.debug(f'Rebuilding "{STUDY_CACHE}"...')
+    study_cache = compile_study(config, old_cache)
+
+    tmp = f'{STUDY_CACHE}.{os.getpid()}.tmp'
+    with open(tmp, 'w') as fh:
+        json.dump(study_cache, fh)
+    os.replace(tmp, STUDY_CACHE)
+
+    return study_cache
+
+
+def prepare_query(config, target):
+    query_info = get_study_cache(config)['queries'][target]
+    return (query_info['query'], query_info['hash'])
 
 
 def is_run_needed(config, target):
@@ -207,9 +678,38 @@ def is_run_needed(config, target):
 
     return oldhash != newhash
 
+def record_metric(stage, target=None, seconds=None, *, metrics_file=None, **values):
+    '''Appends one measurement to the JSON-lines metrics file (METRICS_JSONL
+    unless another is given).'''
+    if metrics_file is None:
+        metrics_file = METRICS_JSONL
+    if not metrics_file:
+        return
+
+    entry = {'run': RUN_ID, 'time': round(time.time(), 3), 'stage': stage, 'target': target}
+    if seconds is not None:
+        entry['seconds'] = round(seconds, 6)
+    entry.update(values)
+
+    try:
+        os.makedirs(os.path.dirname(metrics_file) or '.', exist_ok=True)
+        with open(metrics_file, 'a') as fh:
+            fh.write(json.dumps(entry) + '\n')
+    except OSError as e:
+        logger.debug(f'Could not record metric: {e}')
+
+
 class Timer:
-    def __init__(self):
+    '''Times a block of code, and records it as a metric if a stage is given.
+
+    Extra values for the metric can be added to 'values' inside the block.
+    '''
+    def __init__(self, stage=None, target=None, **values):
         self._start = None
+        self.stage = stage
+        self.target = target
+        self.values = values
+        self.elapsed = None
 
     def __enter__(self):
         self._start = time.perf_counter()
@@ -219,5 +719,9 @@ class Timer:
         if self._start is not None:
             elapsed = time.perf_counter() - self._start
             self._start = None
+            self.elapsed = elapsed
 
             logger.debug(f'Elapsed time: {elapsed:0.4f} seconds')
+
+            if self.stage is not None and exc_info[0] is None:
+                record_metric(self.stage, self.target, elapsed, **self.values)